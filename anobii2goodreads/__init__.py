@@ -0,0 +1 @@
+"""Convert aNobii exports and reading progress to Goodreads."""
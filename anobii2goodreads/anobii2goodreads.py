@@ -3,21 +3,16 @@
 import argparse
 import csv
 import logging
-import re
 
-import pyisbn
-
-from config import CONFIG
+from .config import CONFIG
+from .dates import parse_status_date
+from .records import GOODREADS_HEADERS, BookRecord
 
 
 class Anobii2GoodReads(object):
     """Convert Anobii CSV to Goodreads CSV."""
 
-    OUTPUT_HEADERS = ['Title', 'Author', 'Additional Authors', 'ISBN',
-                      'ISBN13', 'My Rating', 'Publisher', 'Binding',
-                      'Number of Pages', 'Year Published', 'Date Read',
-                      'Date Added', 'Bookshelves', 'My Review',
-                      'Private Notes']
+    OUTPUT_HEADERS = list(GOODREADS_HEADERS)
 
     @staticmethod
     def _convert_linebreak(line):
@@ -40,37 +35,7 @@ class Anobii2GoodReads(object):
 
     @staticmethod
     def _convert_date(status):
-        nochinese = re.sub(u'[⺀-⺙⺛-⻳⼀-⿕々〇〡-〩〸-〺〻㐀-䶵一-鿃豈-鶴侮-頻並-龎]',
-                           '',
-                           status,
-                           flags=re.UNICODE)
-        tokens = re.split(r'[，, ]+', nochinese)
-        year, month, day = None, 1, 1
-
-        if len(tokens[-1]) == 4 and tokens[-1].isdigit():
-            year = tokens[-1]
-            if len(tokens) > 1:
-                temp = tokens[-2]
-                if temp.isdigit():
-                    day = temp
-                    if len(tokens) > 2:
-                        temp = tokens[-3]
-                month = {
-                    'Jan': 1,
-                    'Feb': 2,
-                    'Mar': 3,
-                    'Apr': 4,
-                    'May': 5,
-                    'Jun': 6,
-                    'Jul': 7,
-                    'Aug': 8,
-                    'Sep': 9,
-                    'Oct': 10,
-                    'Nov': 11,
-                    'Dec': 12
-                }.get(temp[:3], month)
-            return '{}/{}/{}'.format(year, month, day)
-        return None
+        return parse_status_date(status)
 
     def _detect_status(self, date, text):
         date_read, date_added = None, None
@@ -113,6 +78,8 @@ class Anobii2GoodReads(object):
             return None, None, None, ['to-read']
 
     def convert_entry(self, entry):
+        import pyisbn
+
         ISBN, TITLE, AUTHOR, FORMAT = 'ISBN', 'Title', 'Author', 'Format'
 
         NUM_OF_PAGES, PRIVATE_NOTE = 'Number of pages', 'Private Note'
@@ -200,9 +167,21 @@ class Anobii2GoodReads(object):
             num_of_pages = ''
             year_published = ''
 
-        return (title, author, additional_authors, isbn10, isbn13, my_rating,
-                publisher, binding, num_of_pages, year_published, date_read,
-                date_added, ','.join(bookshelves), my_review, private_notes)
+        return BookRecord(title=title,
+                          author=author,
+                          additional_authors=additional_authors,
+                          isbn10=isbn10,
+                          isbn13=isbn13,
+                          my_rating=my_rating,
+                          publisher=publisher,
+                          binding=binding,
+                          num_of_pages=num_of_pages,
+                          year_published=year_published,
+                          date_read=date_read,
+                          date_added=date_added,
+                          bookshelves=','.join(bookshelves),
+                          my_review=my_review,
+                          private_notes=private_notes)
 
     def __init__(self, *, detect_strings, headers, only_isbn):
         self.detect_strings = detect_strings
@@ -234,39 +213,61 @@ def parse_args():
     return parser.parse_args()
 
 
-def main():
-    """Convert Anobii CSV to Goodreads CSV."""
-    logging.basicConfig(level=logging.INFO)
-    args = parse_args()
+def convert_file(input_file, output_file, lang, only_isbn):
+    """Convert an Anobii CSV file to a Goodreads CSV file.
 
-    with open(args.input_file, newline='',
+    Returns the number of converted entries and the entries which could
+    not be converted.
+    """
+    with open(input_file, newline='',
               encoding='utf8') as anobii_csv, open(
-                  args.output_file,
+                  output_file,
                   'w', newline='',
                   encoding='utf8') as goodread_csv:
         anobii_reader = csv.DictReader(anobii_csv)
         goodreads_writer = csv.writer(goodread_csv)
         a2g = Anobii2GoodReads(
-            detect_strings=CONFIG['detect_strings'][args.lang],
-            headers=CONFIG['headers'][args.lang], only_isbn=args.only_isbn)
+            detect_strings=CONFIG['detect_strings'][lang],
+            headers=CONFIG['headers'][lang], only_isbn=only_isbn)
 
+        converted = 0
         not_convertable = []
         goodreads_writer.writerow(a2g.OUTPUT_HEADERS)
-        for entry in anobii_reader:
-            isbn13 = entry.get('ISBN')
-            if not isbn13:
-                not_convertable.append(entry)
-                continue
-
-            goodreads_writer.writerow(a2g.convert_entry(entry))
-
-        logging.info('Conversion done.')
-        if len(not_convertable) > 0:
-            logging.warning('%d entries not convertable.',
-                            len(not_convertable))
-            for entry in not_convertable:
-                logging.warning('%s by %s', entry[a2g.headers['Title']],
-                                entry[a2g.headers['Author']])
+        for record in convert_entries(anobii_reader, a2g, not_convertable):
+            goodreads_writer.writerow(record.to_goodreads_row())
+            converted += 1
+
+    return converted, not_convertable
+
+
+def convert_entries(entries, a2g, not_convertable):
+    """Yield the converted records of aNobii CSV rows.
+
+    Rows without ISBN are appended to not_convertable as (title, author).
+    """
+    for entry in entries:
+        isbn13 = entry.get('ISBN')
+        if not isbn13:
+            not_convertable.append((entry.get(a2g.headers['Title']),
+                                    entry.get(a2g.headers['Author'])))
+            continue
+
+        yield a2g.convert_entry(entry)
+
+
+def main():
+    """Convert Anobii CSV to Goodreads CSV."""
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    _, not_convertable = convert_file(args.input_file, args.output_file,
+                                      args.lang, args.only_isbn)
+
+    logging.info('Conversion done.')
+    if len(not_convertable) > 0:
+        logging.warning('%d entries not convertable.', len(not_convertable))
+        for title, author in not_convertable:
+            logging.warning('%s by %s', title, author)
 
 
 if __name__ == '__main__':
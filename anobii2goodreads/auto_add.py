@@ -4,12 +4,20 @@ import argparse
 import csv
 import json
 import logging
+import os
+import sys
 
-import requests
+from . import tracing
+from .logs import add_logging_arguments, lazy, setup_logging
+from .records import GOODREADS_HEADERS, BookRecord
+from .utils import (GOODREADS_URL, open_csv, random_wait, read_columns,
+                    throttled_request)
 
-from bs4 import BeautifulSoup as bs
+logger = logging.getLogger(__name__)
 
-from utils import random_wait
+# fields cleared in import rows that should be matched by ISBN only
+ONLY_ISBN_CLEARED = ('title', 'author', 'additional_authors', 'publisher',
+                     'binding', 'num_of_pages', 'year_published')
 
 
 def parse_args():
@@ -18,8 +26,7 @@ def parse_args():
         description='Automatically add new books to Goodreads.')
     parser.add_argument('-c',
                         '--cookie-json',
-                        help='Cookie file.',
-                        required=True)
+                        help='Cookie file, required unless --import-dir.')
     parser.add_argument(
         '-a',
         '--anobii-converted-csv',
@@ -33,195 +40,396 @@ def parse_args():
     parser.add_argument('--list-only',
                         action='store_true',
                         help='Only list books, do not actually add them')
-    return parser.parse_args()
+    parser.add_argument('--goodreads-url',
+                        default=GOODREADS_URL,
+                        help='Goodreads URL, e.g. a local stand-in server.')
+    parser.add_argument('--trace',
+                        help='Write tracing spans to this JSON lines file.')
+    parser.add_argument('--import-dir',
+                        help='Write the missing books as Goodreads import '
+                        'CSV files to this directory instead of adding them.')
+    parser.add_argument('--shard-size',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of books per import file.')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if not args.import_dir and not args.cookie_json:
+        parser.error('--cookie-json is required unless --import-dir is given')
+    return args
+
+
+def normalize_isbn(isbn):
+    """Remove hyphens and spaces from an ISBN, None if empty."""
+    if not isbn:
+        return None
+    return isbn.replace('-', '').replace(' ', '').upper() or None
 
 
 def get_all_present_isbns(path):
     all_isbns = set()
-    with open(path, newline='', encoding='utf8') as goodread_csv:
-        goodreads_reader = csv.DictReader(goodread_csv)
-        for r in goodreads_reader:
-            for name in ('ISBN', 'ISBN13'):
-                isbn = r.get(name, '').strip('="')
-                if isbn != '':
-                    all_isbns.add(isbn)
+    for isbns in read_columns(path, ('ISBN', 'ISBN13'),
+                              unquote=('ISBN', 'ISBN13')):
+        for isbn in isbns:
+            isbn = normalize_isbn(isbn)
+            if isbn:
+                all_isbns.add(isbn)
     return all_isbns
 
 
+def split_pub_date(pub_date):
+    """Split a publication date into year, month and day, None if unknown."""
+    pub_year = pub_month = pub_day = None
+    if pub_date:
+        ts = pub_date.split('-')
+        if len(ts) > 0 and len(ts[0]) == 4:
+            try:
+                pub_year = ts[0]
+            except:
+                pass
+        if len(ts) > 1 and len(ts[1]) == 2:
+            try:
+                d = int(ts[1])
+                if 1 <= d <= 12:
+                    pub_month = str(d)
+            except:
+                pass
+        if len(ts) > 2 and len(ts[2]) == 2:
+            try:
+                d = int(ts[2])
+                if 1 <= d <= 31:
+                    pub_day = str(d)
+            except:
+                pass
+    return pub_year, pub_month, pub_day
+
+
+def normalize_entry(entry):
+    """Normalize the ISBNs of an entry and fill in a missing one."""
+    import pyisbn
+
+    entry.isbn10 = normalize_isbn(entry.isbn10)
+    entry.isbn13 = normalize_isbn(entry.isbn13)
+    if bool(entry.isbn10) != bool(entry.isbn13):
+        try:
+            other = pyisbn.convert(entry.isbn10 or entry.isbn13)
+        except pyisbn.IsbnError:
+            return entry
+        if entry.isbn10:
+            entry.isbn13 = other
+        else:
+            entry.isbn10 = other
+    return entry
+
+
+def dedupe_entries(entries):
+    """Collapse entries sharing an ISBN into one entry per book.
+
+    The first entry of a book is kept, with the fields it lacks taken from
+    the later ones.
+
+    Returns the unique entries and the number of entries merged away.
+    """
+    unique = []
+    by_isbn = {}
+    for entry in entries:
+        first = None
+        for isbn in (entry.isbn13, entry.isbn10):
+            if isbn in by_isbn:
+                first = by_isbn[isbn]
+                break
+        if first is None:
+            unique.append(entry)
+            first = entry
+        else:
+            for name in BookRecord.__slots__:
+                if not getattr(first, name) and getattr(entry, name):
+                    setattr(first, name, getattr(entry, name))
+        for isbn in (entry.isbn13, entry.isbn10, first.isbn13, first.isbn10):
+            if isbn:
+                by_isbn.setdefault(isbn, first)
+    return unique, len(entries) - len(unique)
+
+
 def get_all_missing_entries(path, all_isbns):
     entries = []
     skipped = []
-    with open(path, newline='', encoding='utf8') as anobii_csv:
-        anobii_reader = csv.DictReader(anobii_csv)
-
-        for r in anobii_reader:
-            # try to get ISBNS
-            title = r.get('Title')
-            author = r.get('Author')
-            isbn10 = r.get('ISBN')
-            isbn13 = r.get('ISBN13')
-            publisher = r.get('Publisher')
-            num_of_pages = r.get('Number of Pages')
-            pub_year = pub_month = pub_day = None
-
-            pub_date = r.get('Year Published')
-            if pub_date:
-                ts = pub_date.split('-')
-                if len(ts) > 0 and len(ts[0]) == 4:
-                    try:
-                        pub_year = ts[0]
-                    except:
-                        pass
-                if len(ts) > 1 and len(ts[1]) == 2:
-                    try:
-                        d = int(ts[1])
-                        if 1 <= d <= 12:
-                            pub_month = str(d)
-                    except:
-                        pass
-                if len(ts) > 2 and len(ts[2]) == 2:
-                    try:
-                        d = int(ts[2])
-                        if 1 <= d <= 31:
-                            pub_day = str(d)
-                    except:
-                        pass
-
-            entry = (title, author, isbn10, isbn13, publisher, num_of_pages,
-                     pub_year, pub_month, pub_day)
-
-            correct_isbns = isbn13 and len(isbn13) == 13 and isbn10 and len(
-                isbn10) == 10
-            required_data = title and author
-            if correct_isbns and (isbn10 in all_isbns or isbn13 in all_isbns):
-                # already present
-                pass
-            elif not correct_isbns or not required_data:
-                skipped.append(entry)
-            else:
-                entries.append(entry)
+    for row in read_columns(path, GOODREADS_HEADERS):
+        entry = normalize_entry(BookRecord.from_goodreads_row(row))
+        isbn10, isbn13 = entry.isbn10, entry.isbn13
+
+        correct_isbns = isbn13 and len(isbn13) == 13 and isbn10 and len(
+            isbn10) == 10
+        required_data = entry.title and entry.author
+        if correct_isbns and (isbn10 in all_isbns or isbn13 in all_isbns):
+            # already present
+            pass
+        elif not correct_isbns or not required_data:
+            skipped.append(entry)
+        else:
+            entries.append(entry)
 
     return entries, skipped
 
 
-def add_to_goodreads(entries, cookies):
-    url = 'https://www.goodreads.com/book/new'
-    search_url = 'https://www.goodreads.com/search'
+def is_valid_isbn(isbn):
+    import pyisbn
+
+    try:
+        return bool(isbn) and pyisbn.validate(isbn)
+    except pyisbn.IsbnError:
+        return False
+
+
+def import_row(entry, only_isbn):
+    """Goodreads CSV row of an entry, keeping only its ISBNs if asked."""
+    if not only_isbn:
+        return entry.to_goodreads_row()
+    return tuple('' if name in ONLY_ISBN_CLEARED else value
+                 for name, value in zip(BookRecord.__slots__,
+                                        entry.to_goodreads_row()))
+
+
+def write_import_shards(entries, skipped, all_isbns, output_dir,
+                        shard_size):
+    """Write Goodreads import files of at most shard_size books.
+
+    Books with valid ISBNs are written with their ISBNs only, so that
+    Goodreads matches them by ISBN and not a different edition by title.
+    Books without valid ISBNs but with a title and an author are written
+    with all their data, so that Goodreads can match them by title.
+    Skipped books with an ISBN in all_isbns are already on Goodreads and
+    left out.
+
+    Returns the paths written, the number of books written by ISBN only
+    and with all data, the number of skipped books already present, and
+    the books that could not be written.
+    """
+    rows = []
+    num_only_isbn = 0
+    num_present = 0
+    leftovers = []
+    for entry in entries:
+        rows.append(import_row(entry, True))
+        num_only_isbn += 1
+    for entry in skipped:
+        if any(isbn and isbn in all_isbns
+               for isbn in (entry.isbn13, entry.isbn10)):
+            num_present += 1
+        elif any(is_valid_isbn(isbn)
+                 for isbn in (entry.isbn13, entry.isbn10)):
+            rows.append(import_row(entry, True))
+            num_only_isbn += 1
+        elif entry.title and entry.author:
+            rows.append(import_row(entry, False))
+        else:
+            leftovers.append(entry)
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for start in range(0, len(rows), shard_size):
+        path = os.path.join(output_dir, 'goodreads_import_{:03d}.csv'.format(
+            len(paths) + 1))
+        with open_csv(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(GOODREADS_HEADERS)
+            writer.writerows(rows[start:start + shard_size])
+        paths.append(path)
+    return (paths, num_only_isbn, len(rows) - num_only_isbn, num_present,
+            leftovers)
+
+
+def add_to_goodreads(entries, cookies, base_url=GOODREADS_URL, wait=5,
+                     session=None):
+    import requests
+
+    from bs4 import BeautifulSoup as bs
+
+    # keep connections open between calls when given a session
+    requester = session or requests
+
+    url = base_url + '/book/new'
+    search_url = base_url + '/search'
 
     success = []
     duplicate = []
 
     for entry in entries:
-        (title, author, isbn10, isbn13, publisher, num_of_pages, pub_year,
-         pub_month, pub_day) = entry
-
-        req = requests.request('get',
-                               search_url,
-                               params={'q': isbn13},
-                               cookies=cookies)
-
-        if req.url.startswith('https://www.goodreads.com/book/show/'):
-            logging.warning('{} by {} ({}/{}) duplicate by search'.format(
-                title, author, isbn10, isbn13))
-            duplicate.append(entry)
-            random_wait(2)
-            continue
-
-        # obtain authenticity_token
-        req = requests.request('get', url, cookies=cookies)
-        page = bs(req.content, 'html.parser')
-        book_form = page.find('form', {'id': 'bookForm'})
-        authenticity_token = book_form.find(
-            'input', {'name': 'authenticity_token'})['value']
-
-        # construct payload
-        payload = {'utf8': '✓',
-                   'authenticity_token': authenticity_token,
-                   'book[title]': title,
-                   'book[sort_by_title]': title,
-                   'author[name]': author,
-                   'book[isbn]': isbn10,
-                   'book[isbn13]': isbn13}
-
-        if publisher:
-            payload['book[publisher]'] = publisher
-
-        if num_of_pages:
-            payload['book[num_pages]'] = num_of_pages
-
-        if pub_year:
-            payload['book[publication_year]'] = pub_year
-
-        if pub_month:
-            payload['book[publication_month]'] = pub_month
-
-        if pub_day:
-            payload['book[publication_day]]'] = pub_day
-
-        print(payload)
-
-        # send request
-        req = requests.post(url, payload, cookies=cookies)
-
-        # check result
-        page = bs(req.content, 'html.parser')
-        link = page.find('a', {'class': 'bookTitle'})
-        if link is not None:
-            link = 'https://www.goodreads.com{}'.format(link['href'])
-            logging.warning('success: {}'.format(link))
-            success.append(entry)
-        else:
-            if 'is taken by an existing book' in page.text:
-                logging.warning('duplicate')
+        title, author = entry.title, entry.author
+        isbn10, isbn13 = entry.isbn10, entry.isbn13
+        publisher, num_of_pages = entry.publisher, entry.num_of_pages
+        pub_year, pub_month, pub_day = split_pub_date(entry.year_published)
+        with tracing.span('book', isbn13=isbn13, title=title):
+            req = throttled_request(requester,
+                                    'get',
+                                    search_url,
+                                    params={'q': isbn13},
+                                    cookies=cookies)
+            if req.status_code != 200:
+                logger.error('search failed with %d: %s', req.status_code,
+                             lazy(repr_book, entry))
+                logger.error(
+                    '== error: stop processing to prevent bad things ==')
+                break
+
+            if req.url.startswith(base_url + '/book/show/'):
+                logger.debug('duplicate by search: %s',
+                             lazy(repr_book, entry))
                 duplicate.append(entry)
-            else:
-                logging.warning(
+                random_wait(min(2, wait))
+                continue
+
+            # obtain authenticity_token
+            req = throttled_request(requester, 'get', url, cookies=cookies)
+            with tracing.span('parse'):
+                page = bs(req.content, 'html.parser')
+                book_form = page.find('form', {'id': 'bookForm'})
+                token = None
+                if req.status_code == 200 and book_form is not None:
+                    token = book_form.find('input',
+                                           {'name': 'authenticity_token'})
+            if token is None:
+                logger.error('no book form (%d): %s', req.status_code,
+                             lazy(repr_book, entry))
+                logger.error(
                     '== error: stop processing to prevent bad things ==')
                 break
+            authenticity_token = token['value']
+
+            # construct payload
+            payload = {'utf8': '✓',
+                       'authenticity_token': authenticity_token,
+                       'book[title]': title,
+                       'book[sort_by_title]': title,
+                       'author[name]': author,
+                       'book[isbn]': isbn10,
+                       'book[isbn13]': isbn13}
+
+            if publisher:
+                payload['book[publisher]'] = publisher
+
+            if num_of_pages:
+                payload['book[num_pages]'] = num_of_pages
+
+            if pub_year:
+                payload['book[publication_year]'] = pub_year
 
-        random_wait()
+            if pub_month:
+                payload['book[publication_month]'] = pub_month
+
+            if pub_day:
+                payload['book[publication_day]]'] = pub_day
+
+            logger.debug('payload: %s', payload)
+
+            # send request
+            req = throttled_request(requester, 'post', url, data=payload,
+                                    cookies=cookies)
+
+            # check result
+            with tracing.span('parse'):
+                page = bs(req.content, 'html.parser')
+                link = page.find('a', {'class': 'bookTitle'})
+            if link is not None:
+                logger.debug('added: %s%s', base_url, link['href'])
+                success.append(entry)
+            else:
+                if 'is taken by an existing book' in page.text:
+                    logger.debug('duplicate: %s', lazy(repr_book, entry))
+                    duplicate.append(entry)
+                else:
+                    logger.error(
+                        '== error: stop processing to prevent bad things ==')
+                    break
+
+            random_wait(wait)
 
     return success, duplicate
 
 
-def main():
-    args = parse_args()
+def repr_book(book):
+    """Get book information to print on screen."""
+    return '{} by {} ({}/{})'.format(book.title, book.author, book.isbn10,
+                                     book.isbn13)
 
-    all_isbns = get_all_present_isbns(args.goodreads_csv)
 
-    entries, skipped = get_all_missing_entries(args.anobii_converted_csv,
-                                               all_isbns=all_isbns)
-    logging.warning('== {} entries to add =='.format(len(entries)))
+def repr_books(prefix, books):
+    """One line per book, logged as a single record."""
+    return lazy(lambda: '\n'.join('{}: {}'.format(prefix, repr_book(book))
+                                  for book in books))
+
 
+def add_books(args, entries):
+    """Add entries by form; return False if some of them were not added."""
     with open(args.cookie_json, encoding='utf8') as f:
         cookies = json.load(f)
 
     if args.list_only:
-        for r in entries:
-            logging.warning('to add: {} by {} ({}/{})'.format(r[0], r[1], r[2],
-                                                              r[3]))
+        if entries:
+            logger.info('%s', repr_books('to add', entries))
     else:
-        success, duplicate = add_to_goodreads(entries, cookies)
+        success, duplicate = add_to_goodreads(entries, cookies,
+                                              args.goodreads_url)
 
         if len(success) > 0:
-            logging.warning('== {} files added =='.format(len(success)))
-            for r in success:
-                logging.warning('added: {} by {} ({}/{})'.format(r[0], r[1], r[
-                    2], r[3]))
+            logger.info('== %d files added ==', len(success))
+            logger.info('%s', repr_books('added', success))
 
         if len(duplicate) > 0:
-            logging.warning('== {} files already present =='.format(len(
-                duplicate)))
-            for r in duplicate:
-                logging.warning('duplicate: {} by {} ({}/{})'.format(r[0], r[
-                    1], r[2], r[3]))
+            logger.info('== %d files already present ==', len(duplicate))
+            logger.info('%s', repr_books('duplicate', duplicate))
+
+        if len(success) + len(duplicate) < len(entries):
+            return False
+    return True
+
+
+def main():
+    args = parse_args()
+    setup_logging(args)
+    if args.trace:
+        tracing.configure(args.trace)
+
+    all_isbns = get_all_present_isbns(args.goodreads_csv)
+
+    entries, skipped = get_all_missing_entries(args.anobii_converted_csv,
+                                               all_isbns=all_isbns)
+    entries, merged = dedupe_entries(entries)
+    if merged:
+        # every copy would have cost at least a search request
+        logger.info('== %d duplicate entries merged, %d requests saved ==',
+                    merged, merged)
+    logger.info('== %d entries to add ==', len(entries))
+
+    if args.import_dir:
+        (paths, num_only_isbn, num_full, num_present,
+         skipped) = write_import_shards(entries, skipped, all_isbns,
+                                        args.import_dir, args.shard_size)
+        num_books = num_only_isbn + num_full
+        logger.info('== %d books written to %d import files, %d by ISBN '
+                    'only, %d with all data ==', num_books, len(paths),
+                    num_only_isbn, num_full)
+        if num_present:
+            logger.info('== %d skipped books already on Goodreads ==',
+                        num_present)
+        # each book added by form costs a token fetch and a post
+        logger.info('== up to %d form requests saved; import the files, '
+                    'export again and re-run auto-add for the rest ==',
+                    2 * num_books)
+        for path in paths:
+            logger.info('import file: %s', path)
+        completed = True
+    else:
+        completed = add_books(args, entries)
 
     if len(skipped) > 0:
-        logging.warning('== {} files skipped due to missing data =='.format(
-            len(skipped)))
-        for r in skipped:
-            logging.warning('skipped: {} by {} ({}/{})'.format(r[0], r[1], r[
-                2], r[3]))
+        logger.warning('== %d files skipped due to missing data ==',
+                       len(skipped))
+        logger.info('%s', repr_books('skipped', skipped))
+
+    if not completed:
+        # let callers such as sync know that books are left to add
+        sys.exit(1)
 
 
 if __name__ == '__main__':
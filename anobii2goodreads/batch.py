@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Process many aNobii accounts in one run.
+
+The manifest is a JSON file listing the accounts; paths are relative to
+the manifest:
+
+    {
+        "users": [
+            {"name": "alice",
+             "anobii_csv": "alice/anobii.csv",
+             "goodreads_csv": "alice/goodreads_exported.csv",
+             "cookie_json": "alice/cookies.json",
+             "lang": "en",
+             "only_isbn": false,
+             "books": "alice/anobii_progress.jl",
+             "disk_cache": "alice/update_cache",
+             "wait": 5}
+        ]
+    }
+
+Conversion and filtering are CPU bound and run on a process pool. Adding
+books and updating dates are network bound and run on threads, one per
+account, so every account keeps its own pace between requests. `books`
+and `disk_cache` are optional and enable updating reading dates.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+from .anobii2goodreads import convert_file
+from .auto_add import (add_to_goodreads, dedupe_entries,
+                       get_all_missing_entries, get_all_present_isbns)
+from .config import CONFIG
+from .filter_present import filter_file
+from .update_date import get_read_entries, update_to_goodreads
+
+
+def load_manifest(path):
+    """Load the manifest and resolve paths relative to it."""
+    with open(path, encoding='utf8') as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    users = []
+    for user in manifest['users']:
+        user = dict(user)
+        for key in ('anobii_csv', 'goodreads_csv', 'cookie_json', 'books',
+                    'disk_cache'):
+            if user.get(key):
+                user[key] = os.path.join(base_dir, user[key])
+        user.setdefault('lang', CONFIG['default_lang'])
+        user.setdefault('only_isbn', False)
+        user.setdefault('wait', 5)
+        users.append(user)
+    return users
+
+
+def run_cpu_stages(user, output_dir):
+    """Convert and filter one account; runs in a worker process."""
+    user_dir = os.path.join(output_dir, user['name'])
+    os.makedirs(user_dir, exist_ok=True)
+    converted = os.path.join(user_dir, 'anobii_converted.csv')
+    filtered = os.path.join(user_dir, 'anobii_filtered.csv')
+
+    start = time.perf_counter()
+    num_converted, not_convertable = convert_file(
+        user['anobii_csv'], converted, user['lang'], user['only_isbn'])
+    num_missing = filter_file(converted, user['goodreads_csv'], filtered,
+                              False) - 1
+    return {
+        'converted_csv': converted,
+        'filtered_csv': filtered,
+        'converted': num_converted,
+        'not_convertable': len(not_convertable),
+        'missing': num_missing,
+        'cpu_seconds': time.perf_counter() - start,
+    }
+
+
+def run_network_stages(user, report, list_only):
+    """Add missing books and update dates for one account."""
+    start = time.perf_counter()
+    all_isbns = get_all_present_isbns(user['goodreads_csv'])
+    entries, skipped = get_all_missing_entries(report['converted_csv'],
+                                               all_isbns=all_isbns)
+    entries, merged = dedupe_entries(entries)
+    result = {'to_add': len(entries), 'skipped': len(skipped),
+              'merged': merged}
+
+    update_entries = []
+    disk_cache = None
+    if user.get('books') and user.get('disk_cache'):
+        import diskcache as dc
+
+        disk_cache = dc.Cache(user['disk_cache'])
+        update_entries = list(get_read_entries(user['books'], disk_cache,
+                                               False))
+        result['to_update'] = len(update_entries)
+
+    if not list_only:
+        with open(user['cookie_json'], encoding='utf8') as f:
+            cookies = json.load(f)
+        success, duplicate = add_to_goodreads(entries, cookies,
+                                              wait=user['wait'])
+        result['added'] = len(success)
+        result['duplicate'] = len(duplicate)
+        if update_entries:
+            success, error = update_to_goodreads(update_entries, cookies,
+                                                 disk_cache, None,
+                                                 user['wait'])
+            result['updated'] = len(success)
+            result['update_errors'] = len(error)
+
+    result['network_seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(users, output_dir, jobs, list_only):
+    """Run every account; network stages start as soon as CPU stages end."""
+    reports = {user['name']: {} for user in users}
+    by_name = {user['name']: user for user in users}
+    with ProcessPoolExecutor(max_workers=jobs) as processes, \
+            ThreadPoolExecutor(max_workers=max(1, len(users))) as threads:
+        cpu_futures = {processes.submit(run_cpu_stages, user, output_dir):
+                       user['name'] for user in users}
+        network_futures = {}
+        for future in as_completed(cpu_futures):
+            name = cpu_futures[future]
+            try:
+                reports[name].update(future.result())
+            except Exception as e:
+                logging.exception('%s: conversion failed', name)
+                reports[name]['error'] = repr(e)
+                continue
+            network_futures[threads.submit(run_network_stages, by_name[name],
+                                           reports[name],
+                                           list_only)] = name
+
+        for future in as_completed(network_futures):
+            name = network_futures[future]
+            try:
+                reports[name].update(future.result())
+            except Exception as e:
+                logging.exception('%s: network stage failed', name)
+                reports[name]['error'] = repr(e)
+    return reports
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Sync many aNobii accounts to Goodreads.')
+    parser.add_argument('manifest', help='Manifest JSON file.')
+    parser.add_argument('-o',
+                        '--output-dir',
+                        default='batch',
+                        help='Directory for converted files and the report.')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of conversion processes.')
+    parser.add_argument('--list-only',
+                        action='store_true',
+                        help='Only list books, do not actually add them.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    users = load_manifest(args.manifest)
+
+    start = time.perf_counter()
+    reports = run_batch(users, args.output_dir, args.jobs, args.list_only)
+
+    totals = {}
+    for report in reports.values():
+        for key, value in report.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+    summary = {
+        'elapsed': time.perf_counter() - start,
+        'users': reports,
+        'totals': totals,
+    }
+    report_path = os.path.join(args.output_dir, 'report.json')
+    with open(report_path, 'w', encoding='utf8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    failed = [name for name, report in reports.items() if 'error' in report]
+    logging.info('== %d accounts processed, %d failed ==', len(reports),
+                 len(failed))
+    for key, value in sorted(totals.items()):
+        logging.info('%s: %d', key, value)
+    logging.info('report written to %s', report_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Benchmark parsing the dates of reading statuses.
+
+Compares the date parser with the previous per-row implementation over
+synthetic statuses, or over the Status column of a real export:
+
+    python3 -m anobii2goodreads.bench_dates --rows 200000
+    python3 -m anobii2goodreads.bench_dates --anobii-csv anobii.csv -l zh-tw
+"""
+import argparse
+import logging
+import random
+import re
+import time
+
+from .config import CONFIG
+from .dates import MONTHS, parse_status_date
+from .utils import read_columns
+
+PHRASES = ('Finished reading on {}', 'Reading since {}', 'Not Started',
+           'Abandoned on {}', '讀完 {}', '開始閱讀 {}', '開始還未完成 {}')
+
+
+def legacy_convert_date(status):
+    """The previous implementation, run for every row."""
+    nochinese = re.sub(u'[⺀-⺙⺛-⻳⼀-⿕々〇〡-〩〸-〺〻㐀-䶵一-鿃豈-鶴侮-頻並-龎]',
+                       '',
+                       status,
+                       flags=re.UNICODE)
+    tokens = re.split(r'[，, ]+', nochinese)
+    year, month, day = None, 1, 1
+
+    if len(tokens[-1]) == 4 and tokens[-1].isdigit():
+        year = tokens[-1]
+        if len(tokens) > 1:
+            temp = tokens[-2]
+            if temp.isdigit():
+                day = temp
+                if len(tokens) > 2:
+                    temp = tokens[-3]
+            month = dict(MONTHS).get(temp[:3], month)
+        return '{}/{}/{}'.format(year, month, day)
+    return None
+
+
+def make_statuses(num_rows, num_days):
+    """Statuses of a shelf where books were read on ``num_days`` days."""
+    rng = random.Random(0)
+    dates = []
+    for _ in range(num_days):
+        layout = rng.choice(('{m} {d:02d}, {y}', '{m} {d}, {y}', '{y}',
+                             '{d} {m} {y}'))
+        dates.append(layout.format(m=rng.choice(list(MONTHS)),
+                                   d=rng.randint(1, 28),
+                                   y=rng.randint(1995, 2020)))
+    return [rng.choice(PHRASES).format(rng.choice(dates))
+            for _ in range(num_rows)]
+
+
+def time_parser(parser, statuses, repeat):
+    best = None
+    for _ in range(repeat):
+        if hasattr(parser, 'cache_clear'):
+            parser.cache_clear()
+        start = time.perf_counter()
+        for status in statuses:
+            parser(status)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark parsing the dates of reading statuses.')
+    parser.add_argument('--anobii-csv',
+                        help='Take the statuses from this aNobii export.')
+    parser.add_argument('-l',
+                        dest='lang',
+                        default=CONFIG['default_lang'],
+                        choices=tuple(CONFIG['detect_strings']),
+                        help='Language of the export.')
+    parser.add_argument('--rows',
+                        type=int,
+                        default=100000,
+                        help='Number of synthetic statuses.')
+    parser.add_argument('--days',
+                        type=int,
+                        default=2000,
+                        help='Number of distinct dates in synthetic statuses.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of runs; the best one is reported.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.anobii_csv:
+        column = CONFIG['headers'][args.lang]['Status']
+        statuses = [status for status, in read_columns(args.anobii_csv,
+                                                        (column,))
+                    if status]
+    else:
+        statuses = make_statuses(args.rows, args.days)
+
+    mismatches = [status for status in set(statuses)
+                  if parse_status_date(status) != legacy_convert_date(status)]
+    for status in mismatches[:10]:
+        logging.warning('different result for %r', status)
+
+    legacy = time_parser(legacy_convert_date, statuses, args.repeat)
+    memoized = time_parser(parse_status_date, statuses, args.repeat)
+    logging.info('%d statuses, %d distinct, %d mismatches', len(statuses),
+                 len(set(statuses)), len(mismatches))
+    logging.info('%-10s %8.1f ms %10.0f rows/s', 'legacy', legacy * 1000,
+                 len(statuses) / legacy)
+    logging.info('%-10s %8.1f ms %10.0f rows/s  %.1fx', 'memoized',
+                 memoized * 1000, len(statuses) / memoized, legacy / memoized)
+
+
+if __name__ == '__main__':
+    main()
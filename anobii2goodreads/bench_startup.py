@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Measure the startup time of every subcommand.
+
+Each subcommand is started with `--help` in a fresh interpreter, which
+covers interpreter start, the dispatcher and the imports of the tool.
+"""
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .cli import COMMANDS
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_command(command, repeat, env):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the startup time of every subcommand.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=10,
+                        help='Number of runs per subcommand.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeat, env)
+    logging.info('%-12s median %6.1f ms', 'python',
+                 statistics.median(baseline) * 1000)
+    for name in COMMANDS:
+        timings = time_command(
+            [sys.executable, '-m', 'anobii2goodreads.cli', name, '--help'],
+            args.repeat, env)
+        logging.info('%-12s median %6.1f ms  min %6.1f ms', name,
+                     statistics.median(timings) * 1000, min(timings) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Shared command line dispatcher for all anobii2goodreads tools.
+
+Only the module of the requested subcommand is imported, and the modules
+import their heavy dependencies lazily, so e.g. `--help` or `--list-only`
+runs stay fast.
+"""
+import importlib
+import sys
+
+# subcommand -> (module, description)
+COMMANDS = {
+    'convert': ('anobii2goodreads.anobii2goodreads',
+                'Convert aNobii CSV to Goodreads CSV.'),
+    'convert-server': ('anobii2goodreads.convert_server',
+                       'Serve conversions over HTTP with warm workers.'),
+    'filter': ('anobii2goodreads.filter_present',
+               'Filter entries already present in Goodreads.'),
+    'auto-add': ('anobii2goodreads.auto_add',
+                 'Automatically add new books to Goodreads.'),
+    'update-date': ('anobii2goodreads.update_date',
+                    'Update started dates on Goodreads.'),
+    'sync': ('anobii2goodreads.sync',
+             'Run the whole sync, skipping up to date stages.'),
+    'batch': ('anobii2goodreads.batch',
+              'Sync many accounts listed in a manifest.'),
+    'queue': ('anobii2goodreads.work_queue',
+              'Queue books and run workers that add or update them.'),
+    'daemon': ('anobii2goodreads.daemon',
+               'Keep syncing in the background, with a control socket.'),
+    'trace-report': ('anobii2goodreads.tracing',
+                     'Summarize a trace written with --trace.'),
+}
+
+
+def usage():
+    lines = ['usage: anobii2goodreads COMMAND [ARGS...]', '', 'commands:']
+    for name, (_, description) in COMMANDS.items():
+        lines.append('  {:<14} {}'.format(name, description))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    if argv[0] not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        sys.exit('unknown command: {}'.format(argv[0]))
+
+    module = importlib.import_module(COMMANDS[argv[0]][0])
+    # let the tool parse its own arguments
+    sys.argv = ['anobii2goodreads ' + argv[0]] + argv[1:]
+    module.main()
+
+
+if __name__ == '__main__':
+    main()
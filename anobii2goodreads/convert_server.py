@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Serve conversions over HTTP with warm converters.
+
+Converters for every language are created once, in a pool of workers,
+so an upload does not pay for interpreter start and imports:
+
+    curl -T anobii.csv 'http://127.0.0.1:8002/convert?lang=en' \\
+        -o anobii_converted.csv
+
+`POST`/`PUT /convert` takes the aNobii CSV as the body, with a length or
+chunked, and streams the result back while reading it. Parameters:
+
+    lang        language of the export, `en` by default
+    only_isbn   `1` to keep only ISBN, like `convert -o`
+    format      `csv` (default) or `jsonl`, one JSON object per book
+
+`GET /metrics` returns the queue depth, throughput and latencies.
+"""
+import argparse
+import collections
+import csv
+import io
+import json
+import logging
+import queue
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from .anobii2goodreads import Anobii2GoodReads, convert_entries
+from .config import CONFIG
+
+# send the response in chunks of about this size
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class RequestBody(io.RawIOBase):
+    """Read a request body of known length or with chunked encoding."""
+
+    def __init__(self, rfile, length=None, chunked=False):
+        self.rfile = rfile
+        self.remaining = length or 0
+        self.chunked = chunked
+        self.done = not chunked and not length
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        size = int(self.rfile.readline().split(b';')[0], 16)
+        if size == 0:
+            # skip trailers
+            while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            self.done = True
+        self.remaining = size
+
+    def readinto(self, buffer):
+        if self.chunked and not self.done and not self.remaining:
+            self._next_chunk()
+        if self.done:
+            return 0
+        data = self.rfile.read(min(len(buffer), self.remaining))
+        if not data:
+            self.done = True
+            return 0
+        self.remaining -= len(data)
+        if not self.remaining:
+            if self.chunked:
+                # end of the chunk
+                self.rfile.readline()
+            else:
+                self.done = True
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class ChunkedWriter(object):
+    """Text sink sending its content with chunked transfer encoding."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.parts).encode('utf8')
+        self.parts = []
+        self.size = 0
+        if data:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def close(self):
+        self.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class ConverterPool(object):
+    """Workers holding a warm converter for every language."""
+
+    def __init__(self, size):
+        import pyisbn  # noqa: F401, imported once for all conversions
+
+        self.size = size
+        self.workers = queue.Queue()
+        for _ in range(size):
+            self.workers.put({
+                (lang, only_isbn): Anobii2GoodReads(
+                    detect_strings=CONFIG['detect_strings'][lang],
+                    headers=CONFIG['headers'][lang],
+                    only_isbn=only_isbn)
+                for lang in CONFIG['detect_strings']
+                for only_isbn in (False, True)})
+
+    def acquire(self):
+        return self.workers.get()
+
+    def release(self, worker):
+        self.workers.put(worker)
+
+
+class ServiceMetrics(object):
+    """Counters and recent latencies of the service."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.waiting = 0
+        self.active = 0
+        self.requests = 0
+        self.errors = 0
+        self.rows = 0
+        self.not_convertable = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.waits = collections.deque(maxlen=window)
+
+    def update(self, **changes):
+        with self._lock:
+            for name, change in changes.items():
+                setattr(self, name, getattr(self, name) + change)
+
+    def record(self, wait, latency, rows, not_convertable, error):
+        with self._lock:
+            self.waits.append(wait)
+            self.latencies.append(latency)
+            self.requests += 1
+            self.rows += rows
+            self.not_convertable += not_convertable
+            self.errors += bool(error)
+
+    @staticmethod
+    def percentiles(values):
+        values = sorted(values)
+        if not values:
+            return {}
+        return {name: values[min(len(values) - 1, int(len(values) * q))]
+                for name, q in (('p50', 0.5), ('p95', 0.95), ('max', 1.0))}
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started,
+                'queue_depth': self.waiting,
+                'active': self.active,
+                'requests': self.requests,
+                'errors': self.errors,
+                'rows': self.rows,
+                'not_convertable': self.not_convertable,
+                'latency': self.percentiles(self.latencies),
+                'queue_wait': self.percentiles(self.waits),
+            }
+
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, indent=2).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            metrics = self.server.metrics.snapshot()
+            metrics['workers'] = self.server.pool.size
+            self._send_json(metrics)
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/convert':
+            self._send_json({'error': 'not found'}, status=404)
+            return
+        params = {key: values[-1] for key, values in parse_qs(
+            url.query).items()}
+        lang = params.get('lang', CONFIG['default_lang'])
+        output_format = params.get('format', 'csv')
+        only_isbn = params.get('only_isbn') in ('1', 'true', 'yes')
+        if lang not in CONFIG['detect_strings']:
+            self._send_json({'error': 'unknown lang: {}'.format(lang)},
+                            status=400)
+            return
+        if output_format not in CONTENT_TYPES:
+            self._send_json({'error': 'unknown format: {}'.format(
+                output_format)}, status=400)
+            return
+
+        chunked = 'chunked' in self.headers.get('Transfer-Encoding', '')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = io.TextIOWrapper(io.BufferedReader(
+            RequestBody(self.rfile, length, chunked)),
+                                encoding='utf-8-sig', newline='')
+
+        metrics = self.server.metrics
+        start = time.perf_counter()
+        metrics.update(waiting=1)
+        worker = self.server.pool.acquire()
+        wait = time.perf_counter() - start
+        metrics.update(waiting=-1, active=1)
+
+        rows = 0
+        not_convertable = []
+        error = None
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES[output_format])
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            out = ChunkedWriter(self.wfile)
+            records = convert_entries(csv.DictReader(body),
+                                      worker[(lang, only_isbn)],
+                                      not_convertable)
+            if output_format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(Anobii2GoodReads.OUTPUT_HEADERS)
+                for record in records:
+                    writer.writerow(record.to_goodreads_row())
+                    rows += 1
+            else:
+                for record in records:
+                    out.write(json.dumps(record.to_dict(),
+                                         ensure_ascii=False) + '\n')
+                    rows += 1
+            out.close()
+        except Exception as e:
+            # the status is already sent, so drop the connection
+            logging.exception('conversion failed')
+            error = e
+            self.close_connection = True
+        finally:
+            self.server.pool.release(worker)
+            metrics.update(active=-1)
+            metrics.record(wait, time.perf_counter() - start, rows,
+                           len(not_convertable), error)
+            # read what is left of the body so the connection can be reused
+            if error is None:
+                body.read()
+
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class ConvertServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers):
+        super(ConvertServer, self).__init__(address, ConvertHandler)
+        self.pool = ConverterPool(workers)
+        self.metrics = ServiceMetrics()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Serve conversions over HTTP with warm converters.')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address.')
+    parser.add_argument('--port', type=int, default=8002, help='Bind port.')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=4,
+                        help='Number of conversions running at once; more '
+                        'uploads wait in the queue.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = ConvertServer((args.host, args.port), args.workers)
+    logging.info('serving conversions on %s', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
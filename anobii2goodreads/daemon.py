@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""Keep syncing aNobii to Goodreads in the background.
+
+The daemon loads the cookies, the index of ISBNs present on Goodreads,
+an HTTP session and the update cache once, then polls the aNobii export
+and the crawled reading progress. Only what changed since the last run
+goes through auto_add and update_date:
+
+    anobii2goodreads daemon run -c COOKIE_JSON -a anobii.csv \\
+        -g goodreads_exported.csv -b anobii_progress.jl -d update_cache
+
+A local control socket reports the status and triggers runs on demand:
+
+    anobii2goodreads daemon ctl status
+    anobii2goodreads daemon ctl trigger
+    anobii2goodreads daemon ctl stop
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from .anobii2goodreads import convert_file
+from .auto_add import (add_to_goodreads, dedupe_entries,
+                       get_all_missing_entries, get_all_present_isbns)
+from .config import CONFIG
+from .logs import add_logging_arguments, setup_logging
+from .update_date import parse_read_entries, update_to_goodreads
+from .utils import GOODREADS_URL
+
+CONTROL_COMMANDS = ('status', 'trigger', 'stop')
+
+
+def file_signature(path):
+    """Modification time and size of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class SyncDaemon(object):
+    """Run incremental syncs with state kept between runs."""
+
+    def __init__(self, args):
+        import diskcache as dc
+        import requests
+
+        self.args = args
+        with open(args.cookie_json, encoding='utf8') as f:
+            self.cookies = json.load(f)
+        self.session = requests.Session()
+        self.disk_cache = None
+        if args.disk_cache:
+            self.disk_cache = dc.Cache(args.disk_cache)
+        self.converted = os.path.join(args.work_dir, 'anobii_converted.csv')
+
+        self.present_isbns = set()
+        self.signatures = {}
+        # ISBN-13s already added or found on Goodreads by this daemon
+        self.handled = set()
+        # how far the progress file has been read
+        self.progress_offset = 0
+
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {
+            'started': time.time(),
+            'runs': 0,
+            'running': False,
+            'last_run': None,
+            'next_run': None,
+            'added': 0,
+            'duplicate': 0,
+            'updated': 0,
+            'errors': 0,
+        }
+
+    def changed(self, path):
+        """Whether a file changed since the last call."""
+        signature = file_signature(path)
+        if signature is None or signature == self.signatures.get(path):
+            return False
+        self.signatures[path] = signature
+        return True
+
+    def sync_books(self):
+        """Add the books of the export that are missing on Goodreads."""
+        args = self.args
+        if self.changed(args.goodreads_csv):
+            self.present_isbns = get_all_present_isbns(args.goodreads_csv)
+            logging.info('%d ISBNs present on Goodreads',
+                         len(self.present_isbns))
+        if not self.changed(args.anobii_csv):
+            return
+
+        convert_file(args.anobii_csv, self.converted, args.lang,
+                     args.only_isbn)
+        entries, _ = get_all_missing_entries(self.converted,
+                                             self.present_isbns)
+        entries, _ = dedupe_entries(entries)
+        entries = [entry for entry in entries
+                   if entry.isbn13 not in self.handled]
+        if not entries:
+            return
+        logging.info('adding %d books', len(entries))
+        success, duplicate = add_to_goodreads(entries, self.cookies,
+                                              args.goodreads_url, args.wait,
+                                              self.session)
+        for entry in success + duplicate:
+            self.handled.add(entry.isbn13)
+            self.present_isbns.update((entry.isbn10, entry.isbn13))
+        num_errors = len(entries) - len(success) - len(duplicate)
+        if num_errors:
+            # retry the remaining books on the next run
+            del self.signatures[args.anobii_csv]
+        with self.lock:
+            self.stats['added'] += len(success)
+            self.stats['duplicate'] += len(duplicate)
+            self.stats['errors'] += num_errors
+
+    def sync_progress(self):
+        """Update the dates of books appended to the progress file."""
+        args = self.args
+        if not args.books or self.disk_cache is None:
+            return
+        signature = file_signature(args.books)
+        if signature is None or signature[1] == self.progress_offset:
+            return
+        if signature[1] < self.progress_offset:
+            # the file was written again from scratch
+            self.progress_offset = 0
+
+        with open(args.books, 'rb') as f:
+            f.seek(self.progress_offset)
+            data = f.read()
+        # leave a line still being written for the next run
+        data = data[:data.rfind(b'\n') + 1]
+        entries = list(parse_read_entries(
+            data.decode('utf8').splitlines(), self.disk_cache,
+            args.skip_error))
+        if entries:
+            logging.info('updating %d books', len(entries))
+            success, error = update_to_goodreads(entries, self.cookies,
+                                                 self.disk_cache, None,
+                                                 args.wait,
+                                                 args.goodreads_url,
+                                                 self.session)
+        else:
+            success, error = [], []
+        # only now, so a failed run reads the chunk again; books already
+        # updated are skipped through the update cache
+        self.progress_offset += len(data)
+        with self.lock:
+            self.stats['updated'] += len(success)
+            self.stats['errors'] += len(error)
+
+    def run_once(self):
+        with self.lock:
+            self.stats['running'] = True
+        try:
+            self.sync_books()
+            self.sync_progress()
+        except Exception:
+            logging.exception('sync failed')
+            # look at every file again on the next run
+            self.signatures.clear()
+            with self.lock:
+                self.stats['errors'] += 1
+        finally:
+            with self.lock:
+                self.stats['running'] = False
+                self.stats['runs'] += 1
+                self.stats['last_run'] = time.time()
+
+    def serve(self):
+        """Run until stopped, every interval or when triggered."""
+        while not self.stopped.is_set():
+            self.run_once()
+            with self.lock:
+                self.stats['next_run'] = time.time() + self.args.interval
+            self.wakeup.wait(self.args.interval)
+            self.wakeup.clear()
+
+    def trigger(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def status(self):
+        with self.lock:
+            status = dict(self.stats)
+        status['present_isbns'] = len(self.present_isbns)
+        status['progress_offset'] = self.progress_offset
+        return status
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Answer one JSON line per command line."""
+
+    def handle(self):
+        daemon = self.server.daemon
+        for line in self.rfile:
+            command = line.decode('utf8').strip()
+            if command == 'status':
+                reply = daemon.status()
+            elif command == 'trigger':
+                daemon.trigger()
+                reply = {'ok': True}
+            elif command == 'stop':
+                daemon.stop()
+                reply = {'ok': True}
+            else:
+                reply = {'error': 'unknown command: {}'.format(command)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf8'))
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        os.chmod(path, 0o600)
+        self.daemon = daemon
+
+
+def send_command(path, command):
+    """Send a command to a running daemon and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((command + '\n').encode('utf8'))
+        sock.shutdown(socket.SHUT_WR)
+        reply = sock.makefile(encoding='utf8').readline()
+    return json.loads(reply)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Keep syncing aNobii to Goodreads in the background.')
+    parser.add_argument('--socket',
+                        default='anobii2goodreads.sock',
+                        help='Control socket path.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help='Run the daemon.')
+    run.add_argument('-c',
+                     '--cookie-json',
+                     help='Goodreads cookie file.',
+                     required=True)
+    run.add_argument('-a',
+                     '--anobii-csv',
+                     help='aNobii CSV export file',
+                     required=True)
+    run.add_argument('-g',
+                     '--goodreads-csv',
+                     help='Goodreads CSV export file',
+                     required=True)
+    run.add_argument('-b',
+                     '--books',
+                     help='Book items produced by scrapy, to update dates.')
+    run.add_argument('-d',
+                     '--disk-cache',
+                     help='Cache file to record updated items.')
+    run.add_argument('-l',
+                     dest='lang',
+                     default=CONFIG['default_lang'],
+                     choices=tuple(CONFIG['detect_strings']),
+                     help='Input language.')
+    run.add_argument('-o',
+                     '--only-isbn',
+                     action='store_true',
+                     help='Keep only ISBN, discard book info.')
+    run.add_argument('-w',
+                     '--work-dir',
+                     default='daemon',
+                     help='Directory for intermediate files.')
+    run.add_argument('--interval',
+                     type=float,
+                     default=600,
+                     help='Seconds between polls.')
+    run.add_argument('--wait', type=int, default=5, help='Seconds to wait.')
+    run.add_argument('--skip-error',
+                     action='store_true',
+                     help='Skip error items')
+    run.add_argument('--goodreads-url',
+                     default=GOODREADS_URL,
+                     help='Goodreads URL, e.g. a local stand-in server.')
+    add_logging_arguments(run)
+
+    ctl = commands.add_parser('ctl', help='Control a running daemon.')
+    ctl.add_argument('action', choices=CONTROL_COMMANDS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'ctl':
+        try:
+            reply = send_command(args.socket, args.action)
+        except OSError as e:
+            sys.exit('cannot reach the daemon at {}: {}'.format(args.socket,
+                                                                e))
+        print(json.dumps(reply, indent=2))
+        return
+
+    setup_logging(args)
+    os.makedirs(args.work_dir, exist_ok=True)
+    daemon = SyncDaemon(args)
+    server = ControlServer(args.socket, daemon)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info('control socket: %s', args.socket)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(args.socket)
+        if daemon.disk_cache is not None:
+            daemon.disk_cache.close()
+
+
+if __name__ == '__main__':
+    main()
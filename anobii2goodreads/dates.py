@@ -0,0 +1,59 @@
+"""Parse the dates in aNobii reading statuses.
+
+Statuses end with a date, e.g. ``Finished reading on Jan 15, 2015`` or
+``Reading since 2016``, in English or with Chinese words around it.
+Statuses repeat a lot across a shelf, so results are memoized per
+distinct status string.
+"""
+import functools
+import re
+
+# CJK characters, removed before looking for the date
+CJK_RE = re.compile(u'[⺀-⺙⺛-⻳⼀-⿕々〇〡-〩〸-〺〻㐀-䶵一-鿃豈-鶴侮-頻並-龎]',
+                    flags=re.UNICODE)
+
+# the last three tokens separated by commas or spaces, the last one being
+# a year: [month or day] [day] year
+DATE_RE = re.compile(r'(?<![^，, ])'
+                     r'(?:(?:(?P<first>[^，, ]+)[，, ]+)?'
+                     r'(?P<second>[^，, ]+)[，, ]+)?'
+                     r'(?P<year>\d{4})\Z')
+
+MONTHS = {
+    'Jan': 1,
+    'Feb': 2,
+    'Mar': 3,
+    'Apr': 4,
+    'May': 5,
+    'Jun': 6,
+    'Jul': 7,
+    'Aug': 8,
+    'Sep': 9,
+    'Oct': 10,
+    'Nov': 11,
+    'Dec': 12
+}
+
+# number of distinct statuses to remember
+CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_status_date(status):
+    """Return the date of a status as ``year/month/day``, or None.
+
+    Month and day default to 1 when the status only has a year.
+    """
+    match = DATE_RE.search(CJK_RE.sub('', status))
+    if match is None:
+        return None
+    year, first, second = match.group('year', 'first', 'second')
+    month, day = 1, 1
+    if second is not None:
+        if second.isdigit():
+            day = second
+            # "Jan 15, 2015"; without a month token the day is looked up,
+            # which keeps the default month
+            second = first or second
+        month = MONTHS.get(second[:3], month)
+    return '{}/{}/{}'.format(year, month, day)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""A local stand-in for the parts of Goodreads used by auto_add/update_date.
+
+Implements `/search` redirects, `/book/show`, `/book/new` with authenticity
+tokens and `/review/edit` forms with `readingSessionDatePicker` fields, with
+configurable latency, error rate and 429 throttling.
+"""
+import argparse
+import html
+import logging
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+SEARCH_PAGE = '<html><body><p>No results.</p></body></html>'
+
+BOOK_PAGE = '''<html><body>
+<h1 id="bookTitle">{title}</h1>
+<a class="actionLinkLite" href="/review/edit/{book_id}">edit</a>
+</body></html>'''
+
+NEW_BOOK_PAGE = '''<html><body>
+<form id="bookForm" method="post" action="/book/new">
+<input type="hidden" name="authenticity_token" value="{token}"/>
+<input type="text" name="book[title]"/>
+</form>
+</body></html>'''
+
+CREATED_PAGE = '''<html><body>
+<a class="bookTitle" href="/book/show/{book_id}">{title}</a>
+</body></html>'''
+
+TAKEN_PAGE = '''<html><body>
+<p>ISBN {isbn} is taken by an existing book.</p>
+</body></html>'''
+
+DATE_FIELDS = (('start', 'year'), ('start', 'month'), ('start', 'day'),
+               ('end', 'year'), ('end', 'month'), ('end', 'day'))
+# hidden session fields, so that the form has 10 date picker fields
+SESSION_FIELDS = ('id', 'percent', 'current_page', 'progress_type')
+
+
+def review_form(book_id, dates):
+    fields = [
+        '<input type="hidden" name="review[cog_explicit]" value="1"/>',
+        '<input type="checkbox" name="add_to_blog" value="1" checked="true"/>',
+        '<textarea name="review[review]"></textarea>',
+    ]
+    for name in SESSION_FIELDS:
+        fields.append('<input type="hidden" name="readingSessionDatePicker'
+                      '[0][{}]" value=""/>'.format(name))
+    for key, part in DATE_FIELDS:
+        selected = dates.get((key, part), '')
+        values = {'year': range(1990, 2031),
+                  'month': range(1, 13),
+                  'day': range(1, 32)}[part]
+        options = ['<option value=""></option>']
+        for value in values:
+            options.append('<option class="setDate" value="{0}"{1}>{0}'
+                           '</option>'.format(value, ' selected="true"'
+                                              if str(value) == selected
+                                              else ''))
+        fields.append('<select name="readingSessionDatePicker[0][{}][{}]">'
+                      '{}</select>'.format(key, part, ''.join(options)))
+    return ('<html><body><form name="reviewForm" method="post" '
+            'action="/review/update/{}">{}</form></body></html>'.format(
+                book_id, ''.join(fields)))
+
+
+class FakeGoodreadsHandler(BaseHTTPRequestHandler):
+
+    def _send(self, body, status=200, headers=None):
+        data = body.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _redirect(self, location):
+        self._send('', status=302, headers={'Location': location})
+
+    def _read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf8')
+        return {key: values[-1] for key, values in parse_qs(
+            body, keep_blank_values=True).items()}
+
+    def _check_limits(self):
+        """Apply latency, throttling and random errors; False if handled."""
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if not server.allow_request():
+            self._send('Too Many Requests', status=429,
+                       headers={'Retry-After': '1'})
+            return False
+        if server.error_rate and random.random() < server.error_rate:
+            self._send('Internal Server Error', status=500)
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._check_limits():
+            return
+        server = self.server
+        url = urlparse(self.path)
+        path = url.path.rstrip('/').split('/')
+
+        if url.path == '/search':
+            isbn = parse_qs(url.query).get('q', [''])[0]
+            book_id = server.find_book(isbn)
+            if book_id is None:
+                self._send(SEARCH_PAGE)
+            else:
+                self._redirect('/book/show/{}'.format(book_id))
+        elif len(path) == 4 and path[1:3] == ['book', 'show']:
+            book = server.books.get(path[3])
+            if book is None:
+                self._send('not found', status=404)
+            else:
+                self._send(BOOK_PAGE.format(book_id=path[3],
+                                            title=html.escape(book['title'])))
+        elif url.path == '/book/new':
+            self._send(NEW_BOOK_PAGE.format(token=server.new_token()))
+        elif len(path) == 4 and path[1:3] == ['review', 'edit']:
+            book = server.books.get(path[3])
+            if book is None:
+                self._send('not found', status=404)
+            else:
+                self._send(review_form(path[3], book['dates']))
+        else:
+            self._send('not found', status=404)
+
+    def do_POST(self):
+        if not self._check_limits():
+            return
+        server = self.server
+        url = urlparse(self.path)
+        path = url.path.rstrip('/').split('/')
+        form = self._read_form()
+
+        if url.path == '/book/new':
+            if not server.use_token(form.get('authenticity_token')):
+                self._send('invalid authenticity token', status=422)
+                return
+            for isbn in (form.get('book[isbn]'), form.get('book[isbn13]')):
+                if server.find_book(isbn) is not None:
+                    self._send(TAKEN_PAGE.format(isbn=html.escape(isbn)))
+                    return
+            title = form.get('book[title]', '')
+            book_id = server.add_book(title, form.get('book[isbn]'),
+                                      form.get('book[isbn13]'))
+            self._send(CREATED_PAGE.format(book_id=book_id,
+                                           title=html.escape(title)))
+        elif len(path) == 4 and path[1:3] == ['review', 'update']:
+            book = server.books.get(path[3])
+            if book is None:
+                self._send('not found', status=404)
+                return
+            for key, part in DATE_FIELDS:
+                name = 'readingSessionDatePicker[0][{}][{}]'.format(key, part)
+                if form.get(name):
+                    book['dates'][(key, part)] = form[name]
+            self._send('<html><body>saved</body></html>')
+        else:
+            self._send('not found', status=404)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class FakeGoodreadsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, rate_limit=None):
+        super(FakeGoodreadsServer, self).__init__(address,
+                                                  FakeGoodreadsHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.books = {}
+        self.isbns = {}
+        self.tokens = set()
+        self._lock = threading.Lock()
+        self._allowance = rate_limit or 0
+        self._last_check = time.time()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def allow_request(self):
+        """Token bucket allowing ``rate_limit`` requests per second."""
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.time()
+            self._allowance = min(
+                self.rate_limit,
+                self._allowance + (now - self._last_check) * self.rate_limit)
+            self._last_check = now
+            if self._allowance < 1:
+                return False
+            self._allowance -= 1
+            return True
+
+    def new_token(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.tokens.add(token)
+        return token
+
+    def use_token(self, token):
+        with self._lock:
+            if token in self.tokens:
+                self.tokens.remove(token)
+                return True
+            return False
+
+    def find_book(self, isbn):
+        with self._lock:
+            return self.isbns.get(isbn) if isbn else None
+
+    def add_book(self, title, *isbns, dates=None):
+        with self._lock:
+            book_id = str(len(self.books) + 1)
+            self.books[book_id] = {'title': title, 'dates': dates or {}}
+            for isbn in isbns:
+                if isbn:
+                    self.isbns[isbn] = book_id
+            return book_id
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Serve a fake Goodreads for testing.')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address.')
+    parser.add_argument('--port', type=int, default=8001, help='Bind port.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='Average seconds to wait before responding.')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests answered with 500.')
+    parser.add_argument('--rate-limit',
+                        type=float,
+                        help='Requests per second before answering 429.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = FakeGoodreadsServer((args.host, args.port), args.latency,
+                                 args.error_rate, args.rate_limit)
+    logging.info('serving fake Goodreads on %s', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
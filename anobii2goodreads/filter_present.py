@@ -2,60 +2,70 @@
 import argparse
 import csv
 
-from auto_add import get_all_present_isbns
+from .auto_add import get_all_present_isbns
+from .utils import (column_indexes, open_csv, read_columns,
+                    unquote_goodreads)
 
 
 def get_all_present_isbns_in_anobii(path):
     all_isbns = set()
-    with open(path, newline='', encoding='utf8') as incsv:
+    for isbns in read_columns(path, ('ISBN', 'ISBN13')):
+        for isbn in isbns:
+            if isbn:
+                all_isbns.add(isbn)
+    return all_isbns
+
+
+def cell(row, index):
+    """Value of a column found by column_indexes, '' if missing."""
+    if index is None or index >= len(row):
+        return ''
+    return row[index]
+
+
+def write_missing_rows(input_csv, output, all_isbns, unquote):
+    """Stream the rows of input_csv whose ISBNs are not in all_isbns.
+
+    Returns the number of rows written, including the header.
+    """
+    with open_csv(output, 'w') as outcsv, open_csv(input_csv) as incsv:
         reader = csv.reader(incsv)
-        # skip header
-        next(reader)
+        writer = csv.writer(outcsv)
+        header = next(reader, None)
+        if header is None:
+            return 0
+        writer.writerow(header)
+        isbn_index, isbn13_index = column_indexes(header, ('ISBN', 'ISBN13'))
+
+        written = 1
         for r in reader:
-            for isbn in (r[3], r[4]):
-                if isbn:
-                    all_isbns.add(isbn)
-    return all_isbns
+            isbn = cell(r, isbn_index)
+            isbn13 = cell(r, isbn13_index)
+            if unquote:
+                isbn = unquote_goodreads(isbn)
+                isbn13 = unquote_goodreads(isbn13)
+            if isbn not in all_isbns and isbn13 not in all_isbns:
+                writer.writerow(r)
+                written += 1
+    return written
+
+
+def filter_file(anobii_converted_csv, goodreads_csv, output, reverse):
+    """Write the rows of one file whose books are missing in the other.
+
+    Returns the number of rows written, including the header.
+    """
+    if reverse:
+        all_isbns = get_all_present_isbns_in_anobii(anobii_converted_csv)
+        return write_missing_rows(goodreads_csv, output, all_isbns, True)
+    all_isbns = get_all_present_isbns(goodreads_csv)
+    return write_missing_rows(anobii_converted_csv, output, all_isbns, False)
 
 
 def main():
     args = parse_args()
-
-    if args.reverse:
-        all_isbns = get_all_present_isbns_in_anobii(args.anobii_converted_csv)
-
-        with open(args.output, 'w',
-                  newline='',
-                  encoding='utf8') as outcsv, open(args.goodreads_csv,
-                                                   newline='',
-                                                   encoding='utf8') as incsv:
-            reader = csv.reader(incsv)
-
-            rows = []
-            for r in reader:
-                if r[5].strip('="') not in all_isbns and r[6].strip(
-                        '="') not in all_isbns:
-                    rows.append(r)
-
-            writer = csv.writer(outcsv)
-            writer.writerows(rows)
-    else:
-        all_isbns = get_all_present_isbns(args.goodreads_csv)
-
-        with open(args.output, 'w',
-                  newline='',
-                  encoding='utf8') as outcsv, open(args.anobii_converted_csv,
-                                                   newline='',
-                                                   encoding='utf8') as incsv:
-            reader = csv.reader(incsv)
-
-            rows = []
-            for r in reader:
-                if r[3] not in all_isbns and r[4] not in all_isbns:
-                    rows.append(r)
-
-            writer = csv.writer(outcsv)
-            writer.writerows(rows)
+    filter_file(args.anobii_converted_csv, args.goodreads_csv, args.output,
+                args.reverse)
 
 
 def parse_args():
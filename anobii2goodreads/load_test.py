@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Load-test auto_add and update_date against the fake Goodreads server.
+
+    python3 -m anobii2goodreads.load_test --books 200 --latency 0.05
+"""
+import argparse
+import logging
+import threading
+import time
+
+from .auto_add import add_to_goodreads
+from .fake_goodreads import FakeGoodreadsServer
+from .records import BookRecord
+from .update_date import update_to_goodreads
+
+
+def isbn_pair(index):
+    """Return a valid (ISBN-10, ISBN-13) pair for the synthetic book."""
+    body = '{:09d}'.format(index)
+    check10 = sum((10 - i) * int(d) for i, d in enumerate(body)) % 11
+    isbn10 = body + ('X' if check10 == 1 else str((11 - check10) % 11))
+    digits = '978' + body
+    total = sum(int(d) * (1 if i % 2 == 0 else 3)
+                for i, d in enumerate(digits))
+    return isbn10, digits + str((10 - total % 10) % 10)
+
+
+def make_books(num_books, server, existing):
+    """Create entries for both tools; ``existing`` share already on server."""
+    add_entries = []
+    update_entries = []
+    for index in range(num_books):
+        isbn10, isbn13 = isbn_pair(index)
+        title = 'Book {}'.format(index)
+        if index < num_books * existing:
+            server.add_book(title, isbn10, isbn13)
+        add_entries.append(BookRecord(title=title,
+                                      author='Author {}'.format(index),
+                                      isbn10=isbn10,
+                                      isbn13=isbn13,
+                                      publisher='Publisher',
+                                      num_of_pages='300',
+                                      year_published='2010-01-01'))
+        update_entries.append(BookRecord.from_session(
+            isbn13, title, ('2015', '03', '04', '2015', '05', '06')))
+    return add_entries, update_entries
+
+
+def report(name, elapsed, num_books, num_ok):
+    # only books that went through count, a failed run is not fast
+    logging.info('%-12s %5d books %5d ok %8.2fs %8.1f books/minute', name,
+                 num_books, num_ok, elapsed, num_ok * 60 / max(elapsed,
+                                                               1e-9))
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Load-test auto_add and update_date locally.')
+    parser.add_argument('--books',
+                        type=int,
+                        default=100,
+                        help='Number of books to process.')
+    parser.add_argument('--existing',
+                        type=float,
+                        default=0.5,
+                        help='Fraction of books already on Goodreads.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='Average server latency in seconds.')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests answered with 500.')
+    parser.add_argument('--rate-limit',
+                        type=float,
+                        help='Requests per second before answering 429.')
+    parser.add_argument('--wait',
+                        type=float,
+                        default=0,
+                        help='Seconds the tools wait between books.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    server = FakeGoodreadsServer(('127.0.0.1', 0), args.latency,
+                                 args.error_rate, args.rate_limit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    add_entries, update_entries = make_books(args.books, server,
+                                             args.existing)
+
+    # keep the per-book logging of the tools out of the report
+    logging.getLogger().setLevel(logging.ERROR)
+    results = []
+    start = time.perf_counter()
+    try:
+        success, duplicate = add_to_goodreads(add_entries, {}, server.url,
+                                              args.wait)
+        num_ok = len(success) + len(duplicate)
+    except Exception:
+        logging.exception('auto_add failed')
+        num_ok = 0
+    results.append(('auto_add', time.perf_counter() - start, num_ok))
+
+    start = time.perf_counter()
+    try:
+        success, _ = update_to_goodreads(update_entries, {}, {}, None,
+                                         args.wait, server.url)
+        num_ok = len(success)
+    except Exception:
+        logging.exception('update_date failed')
+        num_ok = 0
+    results.append(('update_date', time.perf_counter() - start, num_ok))
+
+    logging.getLogger().setLevel(logging.INFO)
+    for name, elapsed, num_ok in results:
+        report(name, elapsed, args.books, num_ok)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Logging setup shared by the tools.
+
+Per-book messages are logged at DEBUG with %-style arguments, so they
+cost next to nothing unless `--verbose` is given. They are rate limited
+per message template and can be sampled; summaries always pass, and
+`--log-format json` writes one JSON object per record:
+
+    logger.debug('added: %s', lazy(repr_book, entry))
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+
+TEXT_FORMAT = logging.BASIC_FORMAT
+
+
+class lazy(object):
+    """Call ``func(*args)`` only when the log message is formatted."""
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class RateLimitFilter(logging.Filter):
+    """Limit how often the same per-book DEBUG message is logged.
+
+    At most ``burst`` DEBUG records with the same template pass every
+    ``period`` seconds; the next record passing after that carries the
+    number of suppressed ones in ``record.suppressed``, and ``report``
+    logs what is still suppressed at the end. Only every ``sample``-th
+    record per template is considered at all. Other levels always pass.
+    """
+
+    def __init__(self, burst=20, period=60.0, sample=1):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.period = period
+        self.sample = sample
+        self._lock = threading.Lock()
+        # (logger, level, template) -> [window start, passed, suppressed, seen]
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = [now, 0, 0, 0]
+            counter[3] += 1
+            if self.sample > 1 and (counter[3] - 1) % self.sample:
+                return False
+            if now - counter[0] >= self.period:
+                counter[0], counter[1] = now, 0
+            if counter[1] >= self.burst:
+                counter[2] += 1
+                return False
+            counter[1] += 1
+            if counter[2]:
+                record.suppressed = counter[2]
+                counter[2] = 0
+        return True
+
+    def report(self):
+        """Log the messages suppressed since they last passed."""
+        with self._lock:
+            suppressed = [(key, counter[2])
+                          for key, counter in self._counters.items()
+                          if counter[2]]
+            for counter in self._counters.values():
+                counter[2] = 0
+        for (name, _, template), count in suppressed:
+            logging.getLogger(name).info('%d similar messages suppressed: %s',
+                                         count, template)
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        message = super(TextFormatter, self).format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += ' [{} similar messages suppressed]'.format(suppressed)
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON objects, one per line."""
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def add_logging_arguments(parser):
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        help='Log every book.')
+    parser.add_argument('--log-format',
+                        choices=('text', 'json'),
+                        default='text',
+                        help='Log as text or as JSON lines.')
+    parser.add_argument('--log-sample',
+                        type=int,
+                        default=1,
+                        help='With --verbose, log only one in this many '
+                        'repeated per-book messages.')
+
+
+def setup_logging(args):
+    """Configure the root logger from add_logging_arguments options."""
+    handler = logging.StreamHandler()
+    if args.log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter(TEXT_FORMAT))
+    rate_limit = RateLimitFilter(sample=max(1, args.log_sample))
+    handler.addFilter(rate_limit)
+    # runs before logging.shutdown, which was registered earlier
+    atexit.register(rate_limit.report)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    if args.verbose:
+        # keep the HTTP libraries quiet
+        logging.getLogger('urllib3').setLevel(logging.INFO)
@@ -0,0 +1,94 @@
+"""Book record shared by the converter, auto_add and update_date."""
+
+# fields of a reading session, as crawled from aNobii
+SESSION_FIELDS = ('startaa', 'startmm', 'startgg', 'endaa', 'endmm', 'endgg')
+
+# Goodreads CSV columns, in the order written by the converter
+GOODREADS_HEADERS = ('Title', 'Author', 'Additional Authors', 'ISBN',
+                     'ISBN13', 'My Rating', 'Publisher', 'Binding',
+                     'Number of Pages', 'Year Published', 'Date Read',
+                     'Date Added', 'Bookshelves', 'My Review',
+                     'Private Notes')
+
+
+class BookRecord(object):
+    """One book.
+
+    Fields are strings or None, except ``reading_session``, which is None
+    or a tuple of the SESSION_FIELDS values of the last reading session.
+    """
+
+    # the Goodreads CSV columns, in order, then the reading session
+    __slots__ = ('title', 'author', 'additional_authors', 'isbn10', 'isbn13',
+                 'my_rating', 'publisher', 'binding', 'num_of_pages',
+                 'year_published', 'date_read', 'date_added', 'bookshelves',
+                 'my_review', 'private_notes', 'reading_session')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('unknown fields: {}'.format(', '.join(fields)))
+
+    def __repr__(self):
+        return 'BookRecord(title={!r}, isbn13={!r})'.format(self.title,
+                                                            self.isbn13)
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_goodreads_row(cls, row):
+        """Create a record from values in GOODREADS_HEADERS order."""
+        record = cls()
+        for name, value in zip(cls.__slots__, row):
+            setattr(record, name, value)
+        return record
+
+    def to_goodreads_row(self):
+        """Values in GOODREADS_HEADERS order."""
+        return self.to_tuple()[:len(GOODREADS_HEADERS)]
+
+    @classmethod
+    def from_progress_item(cls, item):
+        """Create a record from an item scraped by the progress spider.
+
+        Returns None if the item has no reading session.
+        """
+        sessions = (item.get('progress') or {}).get('readingProgress')
+        if not sessions:
+            return None
+        return cls.from_session(item.get('isbn13'), item.get('title'),
+                                sessions[-1])
+
+    @classmethod
+    def from_session(cls, isbn13, title, session):
+        """Create a record from a mapping or sequence of session fields."""
+        if hasattr(session, 'get'):
+            session = [session.get(name) for name in SESSION_FIELDS]
+        return cls(isbn13=isbn13,
+                   title=title,
+                   reading_session=tuple(value or ''
+                                         for value in session))
+
+    def session_value(self, name):
+        """Value of a SESSION_FIELDS field, or '' if unknown."""
+        if self.reading_session is None:
+            return ''
+        return self.reading_session[SESSION_FIELDS.index(name)]
+
+    def to_dict(self):
+        """JSON compatible dict with the fields that are set."""
+        data = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = list(value) if isinstance(value, tuple) else value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        if data.get('reading_session') is not None:
+            data['reading_session'] = tuple(data['reading_session'])
+        return cls(**data)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Run the whole aNobii to Goodreads sync as one command.
+
+The stages are the existing entry points, run as a DAG:
+
+    convert -> filter_present
+    convert -> auto_add
+    crawl   -> update_date
+
+With `--follow` the crawl streams books to update_date, which runs at the
+same time and updates each book as soon as it has been crawled.
+
+Each stage is keyed by a hash of its command line and the content of its
+input files. A stage is skipped when its key matches the last successful
+run and its outputs are unchanged, and stages whose dependencies are done
+run concurrently.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .config import CONFIG
+from .update_date import DONE_SUFFIX
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CRAWL_DIR = os.path.join(ROOT_DIR, 'anobiicrawl')
+
+# done_marker: file written when the stage exits, so that a stage
+# following its output stops even if it failed early
+Stage = collections.namedtuple(
+    'Stage', ['name', 'command', 'inputs', 'outputs', 'deps', 'cwd',
+              'always_run', 'done_marker'], defaults=(None,))
+
+
+def file_digest(path):
+    """Hash the content of a file, or return None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(stage):
+    """Hash the command line and the content of the inputs of a stage."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(stage.command).encode('utf8'))
+    for path in stage.inputs:
+        digest.update(path.encode('utf8'))
+        digest.update((file_digest(path) or '').encode('utf8'))
+    return digest.hexdigest()
+
+
+def tool(name):
+    return [sys.executable, '-m', 'anobii2goodreads.cli', name]
+
+
+def build_stages(args):
+    """Build the sync DAG from command line arguments."""
+    work_dir = os.path.abspath(args.work_dir)
+    converted = os.path.join(work_dir, 'anobii_converted.csv')
+    filtered = os.path.join(work_dir, 'anobii_filtered.csv')
+    progress = os.path.join(work_dir, 'anobii_progress.jl')
+    anobii_csv = os.path.abspath(args.anobii_csv)
+    goodreads_csv = os.path.abspath(args.goodreads_csv)
+    cookie_json = os.path.abspath(args.cookie_json)
+
+    convert = tool('convert') + ['-l', args.lang]
+    if args.only_isbn:
+        convert.append('-o')
+
+    stages = [
+        Stage('convert', convert + [anobii_csv, converted], [anobii_csv],
+              [converted], [], None, False),
+        Stage('filter_present',
+              tool('filter') + ['-a', converted,
+                                '-g', goodreads_csv,
+                                '-o', filtered],
+              [converted, goodreads_csv], [filtered], ['convert'], None,
+              False),
+        Stage('auto_add',
+              tool('auto-add') + ['-c', cookie_json,
+                                  '-a', converted,
+                                  '-g', goodreads_csv],
+              [converted, goodreads_csv, cookie_json], [], ['convert'], None,
+              False),
+    ]
+
+    if args.user:
+        crawl = ['scrapy', 'crawl', 'progress',
+                 '-a', 'visited=' + os.path.abspath(args.crawl_cache),
+                 '-a', 'user=' + args.user,
+                 '-a', 'login_path=' + os.path.abspath(args.login_json)]
+        update_date = tool('update-date') + ['-c', cookie_json,
+                                             '-b', progress,
+                                             '-d', os.path.abspath(
+                                                 args.update_cache)]
+        done_marker = None
+        if args.follow:
+            crawl += ['-s', 'PROGRESS_FEED_PATH=' + progress]
+            update_date.append('--follow')
+            done_marker = progress + DONE_SUFFIX
+        else:
+            crawl += ['-o', progress]
+        stages.extend([
+            # the crawl reads remote data and is incremental by itself
+            Stage('crawl', crawl, [], [progress], [], CRAWL_DIR, True,
+                  done_marker),
+            Stage('update_date', update_date, [progress, cookie_json], [],
+                  [] if args.follow else ['crawl'], None, args.follow),
+        ])
+
+    if args.stages:
+        stages = [stage for stage in stages if stage.name in args.stages]
+        names = {stage.name for stage in stages}
+        # dependencies left out are assumed to be up to date
+        stages = [stage._replace(deps=[d for d in stage.deps if d in names])
+                  for stage in stages]
+    return stages
+
+
+class StageCache(object):
+    """Remember the key and output hashes of successful stage runs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                self.state = json.load(f)
+
+    def is_valid(self, stage, key):
+        record = self.state.get(stage.name)
+        if stage.always_run or not record or record['key'] != key:
+            return False
+        return all(file_digest(path) == digest
+                   for path, digest in record['outputs'].items())
+
+    def record(self, stage, key):
+        outputs = {path: file_digest(path) for path in stage.outputs}
+        with self._lock:
+            self.state[stage.name] = {'key': key, 'outputs': outputs}
+            with open(self.path, 'w', encoding='utf8') as f:
+                json.dump(self.state, f, indent=2)
+
+
+def run_stage(stage, cache):
+    """Run one stage unless its cached result is still valid."""
+    key = stage_key(stage)
+    if cache.is_valid(stage, key):
+        logging.info('%s: up to date, skipped', stage.name)
+        return True
+    logging.info('%s: running %s', stage.name, ' '.join(stage.command))
+    # make the package importable when running from a checkout
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+    try:
+        returncode = subprocess.call(stage.command, cwd=stage.cwd, env=env)
+    finally:
+        if stage.done_marker:
+            # the crawl writes it itself only when its pipeline ran
+            open(stage.done_marker, 'a').close()
+    if returncode != 0:
+        logging.error('%s: failed with exit code %d', stage.name, returncode)
+        return False
+    cache.record(stage, key)
+    logging.info('%s: done', stage.name)
+    return True
+
+
+def run_dag(stages, cache, jobs):
+    """Run stages as soon as their dependencies succeeded."""
+    pending = {stage.name: stage for stage in stages}
+    done, failed = set(), set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dep in failed for dep in stage.deps):
+                    logging.warning('%s: skipped, a dependency failed', name)
+                    failed.add(name)
+                    del pending[name]
+                elif all(dep in done for dep in stage.deps):
+                    running[executor.submit(run_stage, stage, cache)] = name
+                    del pending[name]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                (done if future.result() else failed).add(name)
+    return done, failed
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Sync aNobii to Goodreads, skipping up to date stages.')
+    parser.add_argument('-a',
+                        '--anobii-csv',
+                        help='aNobii CSV export file',
+                        required=True)
+    parser.add_argument('-g',
+                        '--goodreads-csv',
+                        help='Goodreads CSV export file',
+                        required=True)
+    parser.add_argument('-c',
+                        '--cookie-json',
+                        help='Goodreads cookie file.',
+                        required=True)
+    parser.add_argument('-w',
+                        '--work-dir',
+                        default='sync',
+                        help='Directory for intermediate files.')
+    parser.add_argument('-l',
+                        dest='lang',
+                        default=CONFIG['default_lang'],
+                        choices=tuple(CONFIG['detect_strings']),
+                        help='Input language.')
+    parser.add_argument('-o',
+                        '--only-isbn',
+                        action='store_true',
+                        help='Keep only ISBN, discard book info.')
+    parser.add_argument('--user',
+                        help='aNobii user name; crawl reading progress and '
+                        'update dates on Goodreads when given.')
+    parser.add_argument('--login-json',
+                        default='anobii.login.json',
+                        help='aNobii login data for the crawl.')
+    parser.add_argument('--crawl-cache',
+                        default='crawl_cache',
+                        help='Cache of crawled books.')
+    parser.add_argument('--update-cache',
+                        default='update_cache',
+                        help='Cache of books with updated dates.')
+    parser.add_argument('--follow',
+                        action='store_true',
+                        help='Update dates while the crawl is running.')
+    parser.add_argument('--stages',
+                        nargs='+',
+                        choices=('convert', 'filter_present', 'auto_add',
+                                 'crawl', 'update_date'),
+                        help='Only run these stages.')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=2,
+                        help='Number of stages to run concurrently.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    cache = StageCache(os.path.join(args.work_dir, 'sync_state.json'))
+    if args.follow:
+        # a marker left by the last crawl would stop update_date right away
+        done_path = os.path.join(args.work_dir,
+                                 'anobii_progress.jl' + DONE_SUFFIX)
+        if os.path.exists(done_path):
+            os.remove(done_path)
+    done, failed = run_dag(build_stages(args), cache, args.jobs)
+    if failed:
+        logging.error('== %d stages failed: %s ==', len(failed),
+                      ', '.join(sorted(failed)))
+        sys.exit(1)
+    logging.info('== %d stages done ==', len(done))
+
+
+if __name__ == '__main__':
+    main()
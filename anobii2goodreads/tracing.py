@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Span based tracing written to a local JSON lines file.
+
+Tools open a root span per book, and HTTP requests, parsing and waits
+open child spans:
+
+    with tracing.span('book', isbn13=isbn13):
+        resp = tracing.request(session, 'get', url)
+        with tracing.span('parse'):
+            ...
+
+Tracing is a no-op until `configure` is called, e.g. by `--trace FILE`.
+Run `anobii2goodreads trace-report FILE` to summarize a trace.
+"""
+import argparse
+import collections
+import contextlib
+import itertools
+import json
+import re
+import threading
+import time
+
+from urllib.parse import urlparse
+
+
+class Tracer(object):
+    """Write finished spans to a JSON lines file."""
+
+    def __init__(self, path=None):
+        self._file = open(path, 'a', encoding='utf8') if path else None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._prefix = '{:x}'.format(int(time.time() * 1000))
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Time the enclosed block; ``attrs`` can be updated inside it."""
+        if not self.enabled:
+            yield attrs
+            return
+        stack = self._stack()
+        span_id = '{}-{}'.format(self._prefix, next(self._ids))
+        parent = stack[-1] if stack else None
+        stack.append((span_id, parent[1] if parent else span_id))
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            duration = time.perf_counter() - started
+            stack.pop()
+            record = {
+                'trace_id': parent[1] if parent else span_id,
+                'span_id': span_id,
+                'parent_id': parent[0] if parent else None,
+                'name': name,
+                'start': start,
+                'duration': duration,
+                'attrs': attrs,
+            }
+            line = json.dumps(record, ensure_ascii=False, default=str)
+            with self._lock:
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_tracer = Tracer()
+
+
+def configure(path):
+    """Start writing spans to ``path``."""
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(path)
+
+
+def span(name, **attrs):
+    return _tracer.span(name, **attrs)
+
+
+def endpoint_of(url):
+    """Group URLs by path, with book and review ids replaced."""
+    return re.sub(r'/\d[^/]*', '/{id}', urlparse(url).path)
+
+
+def request(requester, method, url, **kwargs):
+    """Send a request through ``requester`` (`requests` or a session)."""
+    with span('http', method=method.upper(),
+              endpoint=endpoint_of(url)) as attrs:
+        resp = requester.request(method, url, **kwargs)
+        attrs['status'] = resp.status_code
+        attrs['bytes'] = len(resp.content)
+        # time until the response headers arrived, i.e. network and server
+        attrs['elapsed'] = resp.elapsed.total_seconds()
+        return resp
+
+
+def load_spans(path):
+    with open(path, encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(spans):
+    """Aggregate span durations per stage, per endpoint and per book."""
+    by_id = {s['span_id']: s for s in spans}
+    stages = collections.defaultdict(list)
+    endpoints = collections.defaultdict(list)
+    # time of each root span spent directly in each stage
+    critical = collections.defaultdict(float)
+    roots = [s for s in spans if s['parent_id'] is None]
+
+    for s in spans:
+        stages[s['name']].append(s['duration'])
+        if s['name'] == 'http':
+            endpoints['{} {}'.format(s['attrs'].get('method'),
+                                     s['attrs'].get('endpoint'))].append(
+                                         s['duration'])
+        parent = by_id.get(s['parent_id'])
+        if parent is not None and parent['parent_id'] is None:
+            critical[s['name']] += s['duration']
+
+    total_root = sum(s['duration'] for s in roots)
+    critical['other'] = max(0.0, total_root - sum(critical.values()))
+    return stages, endpoints, critical, roots
+
+
+def print_table(title, groups):
+    print('== {} =='.format(title))
+    print('{:<32} {:>7} {:>10} {:>9} {:>9}'.format('name', 'count', 'total',
+                                                  'mean', 'p95'))
+    for name, durations in sorted(groups.items(),
+                                  key=lambda kv: -sum(kv[1])):
+        durations = sorted(durations)
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        print('{:<32} {:>7} {:>9.2f}s {:>8.3f}s {:>8.3f}s'.format(
+            name, len(durations), sum(durations),
+            sum(durations) / len(durations), p95))
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Summarize a trace written with --trace.')
+    parser.add_argument('trace', help='Trace file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stages, endpoints, critical, roots = summarize(load_spans(args.trace))
+    print_table('stages', stages)
+    print()
+    print_table('endpoints', endpoints)
+    print()
+    total = sum(critical.values())
+    print('== critical path of {} root spans =='.format(len(roots)))
+    for name, duration in sorted(critical.items(), key=lambda kv: -kv[1]):
+        print('{:<32} {:>9.2f}s {:>6.1f}%'.format(
+            name, duration, 100 * duration / total if total else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,18 @@
 """Update started dates on Goodreads."""
 
 import argparse
+import hashlib
 import json
 import logging
+import os
+import time
 
 from urllib.parse import urljoin
 
-import diskcache as dc
-import pyisbn
-import requests
-
-from bs4 import BeautifulSoup as bs
-
-from utils import random_wait
+from . import tracing
+from .logs import add_logging_arguments, lazy, setup_logging
+from .records import SESSION_FIELDS, BookRecord
+from .utils import GOODREADS_URL, random_wait, throttled_request
 
 
 def parse_args():
@@ -24,10 +24,12 @@ def parse_args():
                         '--cookie-json',
                         help='Cookie file.',
                         required=True)
-    parser.add_argument('-b',
-                        '--books',
-                        help='Book items produced by scrapy.',
-                        required=True)
+    books = parser.add_mutually_exclusive_group(required=True)
+    books.add_argument('-b',
+                       '--books',
+                       help='Book items produced by scrapy.')
+    books.add_argument('--books-db',
+                       help='SQLite store written by the scrapy pipeline.')
     parser.add_argument('-d',
                         '--disk-cache',
                         help='Cache file to record updated items.',
@@ -42,42 +44,200 @@ def parse_args():
                         type=int,
                         help='Only update at most this number of books.')
     parser.add_argument('--wait', type=int, default=5, help='Seconds to wait.')
-    return parser.parse_args()
+    parser.add_argument('--goodreads-url',
+                        default=GOODREADS_URL,
+                        help='Goodreads URL, e.g. a local stand-in server.')
+    parser.add_argument('--trace',
+                        help='Write tracing spans to this JSON lines file.')
+    parser.add_argument('-f',
+                        '--follow',
+                        action='store_true',
+                        help='Update books as the crawl appends them to '
+                        '--books, until the crawl ends.')
+    parser.add_argument('--idle-timeout',
+                        type=float,
+                        help='With --follow, also stop when nothing was '
+                        'appended for this number of seconds.')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    if args.follow and not args.books:
+        parser.error('--follow requires --books')
+    return args
+
+
+logger = logging.getLogger(__name__)
+
+# written next to the feed by the crawl's JsonLinesFeedPipeline at the end
+DONE_SUFFIX = '.done'
+# seconds to wait for a followed feed to appear
+FOLLOW_START_TIMEOUT = 600
+
+
+def progress_fingerprint(entry):
+    """Fingerprint the reading dates to be written for a book."""
+    content = '/'.join(entry.reading_session)
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+
+def is_done(entry, disk_cache, skip_error):
+    if entry.isbn13 in disk_cache:
+        state = disk_cache[entry.isbn13]
+        if skip_error and state == 'e':
+            return True
+        # '' is left by older versions for updated books
+        elif state in ('', progress_fingerprint(entry)):
+            return True
+    return False
+
+
+def read_entry(item, disk_cache, skip_error):
+    """Entry to update for a crawled item, or None."""
+    entry = BookRecord.from_progress_item(item)
+    if (entry is not None and entry.session_value('startaa') and
+            not is_done(entry, disk_cache, skip_error)):
+        return entry
+    return None
+
+
+def parse_read_entries(lines, disk_cache, skip_error):
+    """Entries to update from JSON lines of crawled items.
+
+    Feeds are only ever appended to, so a re-crawled book has a line per
+    crawl; only its last line counts.
+    """
+    items = {}
+    for l in lines:
+        if not l.strip():
+            continue
+        item = json.loads(l)
+        # move the book to the position of its last line
+        items.pop(item.get('isbn13'), None)
+        items[item.get('isbn13')] = item
+    for item in items.values():
+        entry = read_entry(item, disk_cache, skip_error)
+        if entry is not None:
+            yield entry
 
 
 def get_read_entries(path, disk_cache, skip_error):
     with open(path, encoding='utf8') as f:
-        for l in f:
-            entry = json.loads(l)
-            if entry['isbn13'] in disk_cache:
-                if skip_error:
-                    continue
-                elif disk_cache[entry['isbn13']] == '':
-                    continue
-            if ('progress' in entry and
-                    'readingProgress' in entry['progress'] and
-                    entry['progress']['readingProgress']):
-                if len(entry['progress']['readingProgress']) > 0:
-                    reading_progress = entry['progress']['readingProgress'][-1]
-                    entry['reading_progress'] = reading_progress
-                    if reading_progress.get('startaa'):
-                        yield entry
-
-
-def check_exists(session, isbns, cookies):
+        yield from parse_read_entries(f, disk_cache, skip_error)
+
+
+def follow_read_entries(path, disk_cache, skip_error, idle_timeout=None):
+    """Entries to update from a feed the crawl is still appending to.
+
+    The lines already in the feed are read like get_read_entries; lines
+    appended later are newer than all of them and used as they come.
+    """
+    offset = 0
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # leave a line still being written to follow_lines
+        data = data[:data.rfind(b'\n') + 1]
+        offset = len(data)
+        yield from parse_read_entries(data.decode('utf8').splitlines(),
+                                      disk_cache, skip_error)
+    for line in follow_lines(path, offset=offset, idle_timeout=idle_timeout):
+        if line.strip():
+            entry = read_entry(json.loads(line), disk_cache, skip_error)
+            if entry is not None:
+                yield entry
+
+
+def follow_lines(path, poll_interval=1.0, idle_timeout=None, offset=0,
+                 start_timeout=FOLLOW_START_TIMEOUT):
+    """Yield lines appended to a file until the crawl writing it ends.
+
+    The crawl has ended when ``<path>.done`` exists or, if ``idle_timeout``
+    is given, when nothing was appended for that number of seconds.
+
+    :param path: JSON lines file written by the crawl
+    :param poll_interval: seconds to wait for new lines
+    :param idle_timeout: seconds without new lines before giving up
+    :param offset: byte offset of the first line to yield
+    :param start_timeout: seconds to wait for the file to appear
+    """
+    done_path = path + DONE_SUFFIX
+    last_data = time.time()
+
+    def crawl_ended():
+        return (os.path.exists(done_path) or
+                idle_timeout is not None and
+                time.time() - last_data > idle_timeout)
+
+    while not os.path.exists(path):
+        if crawl_ended():
+            return
+        if time.time() - last_data > start_timeout:
+            logger.error('%s did not appear within %ds, giving up', path,
+                         start_timeout)
+            return
+        time.sleep(poll_interval)
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        pending = b''
+        ended = False
+        while True:
+            line = f.readline()
+            if line.endswith(b'\n'):
+                yield (pending + line).decode('utf8')
+                pending = b''
+                last_data = time.time()
+                continue
+            if line:
+                # a line still being written
+                pending += line
+                last_data = time.time()
+            if ended:
+                if pending.strip():
+                    yield pending.decode('utf8')
+                return
+            # read once more after the end to get lines written before it
+            ended = crawl_ended()
+            if not ended:
+                time.sleep(poll_interval)
+
+
+def get_read_entries_from_db(path, disk_cache, skip_error):
+    """Read the last reading session of every book from the SQLite store."""
+    import sqlite3
+
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT b.isbn13, b.title, {} FROM books AS b '
+            'JOIN reading_sessions AS s ON s.isbn13 = b.isbn13 '
+            'WHERE s.seq = (SELECT MAX(seq) FROM reading_sessions '
+            '               WHERE isbn13 = b.isbn13) '
+            "AND s.startaa != ''".format(', '.join(
+                's.' + name for name in SESSION_FIELDS)))
+        for row in rows:
+            entry = BookRecord.from_session(row[0], row[1], row[2:])
+            if not is_done(entry, disk_cache, skip_error):
+                yield entry
+    finally:
+        conn.close()
+
+
+def check_exists(session, isbns, cookies, base_url=GOODREADS_URL):
     """Check if a book exists in Goodreads
 
     :param session: requests session
     :param isbns: the ISBNs of the book
     :param cookies: login cookie for Goodreads
+    :param base_url: Goodreads URL
     """
-    search_url = 'https://www.goodreads.com/search'
+    search_url = base_url + '/search'
     for isbn in isbns:
-        resp = session.request('get',
-                               search_url,
-                               params={'q': isbn},
-                               cookies=cookies)
-        if resp.url.startswith('https://www.goodreads.com/book/show/'):
+        resp = throttled_request(session,
+                                 'get',
+                                 search_url,
+                                 params={'q': isbn},
+                                 cookies=cookies)
+        if resp.url.startswith(base_url + '/book/show/'):
             return resp
 
     return None
@@ -88,13 +248,16 @@ def get_edit_url(resp):
 
     :param resp: requests response
     """
-    page = bs(resp.content, 'html.parser')
-    edit_links = page.find_all('a', {'class': 'actionLinkLite'})
-    for edit_link in edit_links:
-        url = edit_link['href']
-        if url.startswith('/review/edit'):
-            return urljoin(resp.url, url)
-    return None
+    from bs4 import BeautifulSoup as bs
+
+    with tracing.span('parse'):
+        page = bs(resp.content, 'html.parser')
+        edit_links = page.find_all('a', {'class': 'actionLinkLite'})
+        for edit_link in edit_links:
+            url = edit_link['href']
+            if url.startswith('/review/edit'):
+                return urljoin(resp.url, url)
+        return None
 
 
 def get_form_data(session, cookies, url):
@@ -104,7 +267,19 @@ def get_form_data(session, cookies, url):
     :param cookies: login cookie for Goodreads
     :param url: edit url
     """
-    resp = session.get(url, cookies=cookies)
+    resp = throttled_request(session, 'get', url, cookies=cookies)
+    with tracing.span('parse'):
+        return parse_form_data(resp, url)
+
+
+def parse_form_data(resp, url):
+    """Parse the review form of an edit page.
+
+    :param resp: requests response of the edit page
+    :param url: edit url
+    """
+    from bs4 import BeautifulSoup as bs
+
     page = bs(resp.content, 'html.parser')
     form = page.find('form', {'name': 'reviewForm'})
     if form:
@@ -141,6 +316,7 @@ def update_book(entry, payload, url, session, cookies):
     :param session: requests session
     :param cookies: login cookie for Goodreads
     """
+    import requests
 
     for key in ('start', 'end'):
         changed = False
@@ -148,7 +324,7 @@ def update_book(entry, payload, url, session, cookies):
         now = []
         for range_x, range_en in (('aa', 'year'), ('mm', 'month'),
                                   ('gg', 'day')):
-            num = entry['reading_progress'].get(key + range_x, '').lstrip('0')
+            num = entry.session_value(key + range_x).lstrip('0')
 
             for name in list(payload):
                 if ('readingSessionDatePicker' in name and
@@ -170,97 +346,108 @@ def update_book(entry, payload, url, session, cookies):
                     break
 
         if changed:
-            logging.warning('%s - changing %s to %s', entry['title'],
-                            '-'.join([str(n) for n in previous]),
-                            '-'.join([str(n) for n in now]))
+            previous_date = '-'.join([str(n) for n in previous])
+            now_date = '-'.join([str(n) for n in now])
             if key == 'start' and len(previous) == 3 and len(
                     now) == 3 and now < previous:
-                logging.warning('ok - choose early date')
+                logger.debug('%s - changing %s to %s: ok - choose early date',
+                             entry.title, previous_date, now_date)
             else:
-                logging.warning('problematic - skip')
+                logger.warning('%s - changing %s to %s: problematic - skip',
+                               entry.title, previous_date, now_date)
                 return False
 
     # send request
-    resp = session.post(url, payload, cookies=cookies)
+    resp = throttled_request(session, 'post', url, data=payload,
+                             cookies=cookies)
 
     return resp.status_code == requests.codes.ok
 
 
-def update_to_goodreads(entries, cookies, disk_cache, limit, wait):
+def update_to_goodreads(entries, cookies, disk_cache, limit, wait,
+                        base_url=GOODREADS_URL, session=None):
     """Update book entries to Goodreads.
 
     :param entries: list of books
     :param cookies: login cookie for Goodreads
     :param disk_cache: cache of updated books
+    :param limit: stop after updating this number of books
+    :param wait: seconds to wait between books
+    :param base_url: Goodreads URL
+    :param session: requests session to reuse, a new one by default
     """
+    import pyisbn
+    import requests
 
-    session = requests.Session()
+    if session is None:
+        session = requests.Session()
 
     success = []
     error = []
 
     for entry in entries:
-        isbn13 = entry['isbn13']
-
-        isbns = [isbn13]
-        try:
-            isbn10 = pyisbn.convert(isbn13)
-            isbns.append(isbn10)
-        except Exception:
-            pass
-
-        resp = check_exists(session, (isbn10, isbn13), cookies)
-        if not resp:
-            logging.warning('{} couldn\'t be found'.format(repr_book(entry)))
-            error.append(entry)
-            disk_cache[entry['isbn13']] = 'e'
-            random_wait(2)
-            continue
-
-        url = get_edit_url(resp)
-        if not url:
-            logging.warning('{}\' url is not found'.format(repr_book(entry)))
-            error.append(entry)
-            disk_cache[entry['isbn13']] = 'e'
-            random_wait(2)
-            continue
-
-        submit_url, form_data = get_form_data(session, cookies, url)
-        if not form_data:
-            logging.warning('{}\' form data is not found'.format(repr_book(
-                entry)))
-            error.append(entry)
-            disk_cache[entry['isbn13']] = 'e'
-            random_wait(2)
-            continue
-
-        # Do not cause any updates
-        form_data['review[cog_explicit]'] = '0'
-        for key in ('add_to_blog', 'add_update'):
-            if key in form_data:
-                form_data[key] = '0'
-
-        # sanity check
-        if len([key for key in form_data if 'readingSessionDatePicker' in key
-                ]) != 10:
-            logging.warning('{}\' date is problematic'.format(repr_book(
-                entry)))
-            logging.warning(form_data)
-            error.append(entry)
-            disk_cache[entry['isbn13']] = 'e'
-            continue
-
-        if update_book(entry, form_data, submit_url, session, cookies):
-            success.append(entry)
-            disk_cache[entry['isbn13']] = ''
-        else:
-            error.append(entry)
-            disk_cache[entry['isbn13']] = 'e'
+        isbn13 = entry.isbn13
+        with tracing.span('book', isbn13=isbn13, title=entry.title):
+            isbns = [isbn13]
+            try:
+                isbn10 = pyisbn.convert(isbn13)
+                isbns.append(isbn10)
+            except Exception:
+                pass
+
+            resp = check_exists(session, (isbn10, isbn13), cookies, base_url)
+            if not resp:
+                logger.warning('%s couldn\'t be found', lazy(repr_book, entry))
+                error.append(entry)
+                disk_cache[entry.isbn13] = 'e'
+                random_wait(min(2, wait))
+                continue
+
+            url = get_edit_url(resp)
+            if not url:
+                logger.warning('%s\' url is not found', lazy(repr_book, entry))
+                error.append(entry)
+                disk_cache[entry.isbn13] = 'e'
+                random_wait(min(2, wait))
+                continue
+
+            submit_url, form_data = get_form_data(session, cookies, url)
+            if not form_data:
+                logger.warning('%s\' form data is not found',
+                               lazy(repr_book, entry))
+                error.append(entry)
+                disk_cache[entry.isbn13] = 'e'
+                random_wait(min(2, wait))
+                continue
+
+            # Do not cause any updates
+            form_data['review[cog_explicit]'] = '0'
+            for key in ('add_to_blog', 'add_update'):
+                if key in form_data:
+                    form_data[key] = '0'
+
+            # sanity check
+            if len([key for key in form_data if 'readingSessionDatePicker' in key
+                    ]) != 10:
+                logger.warning('%s\' date is problematic',
+                               lazy(repr_book, entry))
+                logger.debug('form data: %s', form_data)
+                error.append(entry)
+                disk_cache[entry.isbn13] = 'e'
+                continue
+
+            if update_book(entry, form_data, submit_url, session, cookies):
+                logger.debug('updated: %s', lazy(repr_book, entry))
+                success.append(entry)
+                disk_cache[entry.isbn13] = progress_fingerprint(entry)
+            else:
+                error.append(entry)
+                disk_cache[entry.isbn13] = 'e'
 
-        if limit is not None and len(success) >= limit:
-            break
+            if limit is not None and len(success) >= limit:
+                break
 
-        random_wait()
+            random_wait(wait)
 
     return success, error
 
@@ -275,43 +462,65 @@ def repr_date(year, month, date):
 
 def repr_book(book):
     """Get book information to print on screen."""
-    start_date = repr_date(book['reading_progress'].get('startaa'),
-                           book['reading_progress'].get('startmm'),
-                           book['reading_progress'].get('startgg'))
-    end_date = repr_date(book['reading_progress'].get('endaa'),
-                         book['reading_progress'].get('endmm'),
-                         book['reading_progress'].get('endgg'))
-    return '{} ({}): {}~{}'.format(book['title'], book['isbn13'], start_date,
+    start_date = repr_date(book.session_value('startaa'),
+                           book.session_value('startmm'),
+                           book.session_value('startgg'))
+    end_date = repr_date(book.session_value('endaa'),
+                         book.session_value('endmm'),
+                         book.session_value('endgg'))
+    return '{} ({}): {}~{}'.format(book.title, book.isbn13, start_date,
                                    end_date)
 
 
+def repr_books(prefix, books):
+    """One line per book, logged as a single record."""
+    return lazy(lambda: '\n'.join('{}: {}'.format(prefix, repr_book(book))
+                                  for book in books))
+
+
 def main():
     """Parse Scrapy input and auto update them to Goodreads."""
     args = parse_args()
+    setup_logging(args)
+    if args.trace:
+        tracing.configure(args.trace)
+
+    import diskcache as dc
 
     disk_cache = dc.Cache(args.disk_cache)
-    entries = list(get_read_entries(args.books, disk_cache, args.skip_error))
+    if args.follow:
+        entries = follow_read_entries(args.books, disk_cache,
+                                      args.skip_error, args.idle_timeout)
+    elif args.books_db:
+        entries = list(get_read_entries_from_db(args.books_db, disk_cache,
+                                                args.skip_error))
+    else:
+        entries = list(get_read_entries(args.books, disk_cache,
+                                        args.skip_error))
 
-    logging.warning('== {} entries to update =='.format(len(entries)))
+    if args.follow:
+        logger.info('== following %s ==', args.books)
+    else:
+        logger.info('== %d entries to update ==', len(entries))
 
     with open(args.cookie_json) as cookie_file:
         cookies = json.load(cookie_file)
 
     if args.list_only:
-        for row in entries:
-            logging.warning('to update: {}'.format(repr_book(row)))
+        entries = list(entries)
+        if entries:
+            logger.info('%s', repr_books('to update', entries))
     else:
         success, error = update_to_goodreads(entries, cookies, disk_cache,
-                                             args.limit, args.wait)
+                                             args.limit, args.wait,
+                                             args.goodreads_url)
         if len(success) > 0:
-            logging.warning('== {} files updated =='.format(len(success)))
-            for row in success:
-                logging.warning('updated: {}'.format(repr_book(row)))
+            logger.info('== %d files updated ==', len(success))
+            logger.info('%s', repr_books('updated', success))
 
         if len(error) > 0:
-            logging.warning('== {} files error =='.format(len(error)))
-            for row in error:
-                logging.warning('error: {}'.format(repr_book(row)))
+            logger.warning('== %d files error ==', len(error))
+            logger.info('%s', repr_books('error', error))
 
 
 if __name__ == '__main__':
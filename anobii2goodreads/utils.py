@@ -1,13 +1,91 @@
 #!/usr/bin/env python3
 """Utils to parse data"""
 
+import csv
+import logging
 import random
 import time
 
+from .tracing import request, span
+
+GOODREADS_URL = 'https://www.goodreads.com'
+
+# retries of a request answered with 429 Too Many Requests, and the wait
+# when the answer has no usable Retry-After
+THROTTLE_RETRIES = 3
+THROTTLE_WAIT = 5
+THROTTLE_MAX_WAIT = 60
+
+# read CSV files in large chunks
+CSV_BUFFER_SIZE = 1 << 20
+
 
 def random_wait(how_long=5, max_diff=2):
     """Wait random seconds."""
 
     max_diff = min(how_long, max_diff)
     offset = random.random() * max_diff * 2 - max_diff
-    time.sleep(max(0, how_long + offset))
+    with span('wait'):
+        time.sleep(max(0, how_long + offset))
+
+
+def throttled_request(requester, method, url, **kwargs):
+    """Send a traced request, waiting out 429 answers as told.
+
+    The last response is returned whatever its status, so callers still
+    have to check it.
+    """
+    for attempt in range(THROTTLE_RETRIES + 1):
+        resp = request(requester, method, url, **kwargs)
+        if resp.status_code != 429 or attempt == THROTTLE_RETRIES:
+            return resp
+        try:
+            wait = float(resp.headers.get('Retry-After', THROTTLE_WAIT))
+        except ValueError:
+            # an HTTP date
+            wait = THROTTLE_WAIT
+        wait = min(max(wait, 0), THROTTLE_MAX_WAIT)
+        logging.getLogger(__name__).info('throttled, retry in %.0fs: %s',
+                                         wait, url)
+        with span('wait'):
+            time.sleep(wait)
+
+
+def unquote_goodreads(value):
+    """Remove the ="..." quoting Goodreads puts around ISBNs."""
+    return value.strip('="') if value else value
+
+
+def open_csv(path, mode='r'):
+    return open(path, mode, newline='', encoding='utf8',
+                buffering=CSV_BUFFER_SIZE)
+
+
+def column_indexes(header, columns):
+    """Map column names to their positions in header, or None if absent."""
+    positions = {}
+    for i, name in enumerate(header):
+        positions.setdefault(name, i)
+    return [positions.get(name) for name in columns]
+
+
+def read_columns(path, columns, unquote=()):
+    """Yield a tuple with only the given columns for every row of a CSV file.
+
+    Column positions are resolved from the header once; missing columns and
+    cells are None, like with csv.DictReader. Columns listed in ``unquote``
+    go through unquote_goodreads.
+    """
+    with open_csv(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        indexes = column_indexes(header, columns)
+        unquoted = [name in unquote for name in columns]
+        for row in reader:
+            values = []
+            for i, u in zip(indexes, unquoted):
+                value = row[i] if i is not None and i < len(row) else None
+                values.append(unquote_goodreads(value) if u else value)
+            yield tuple(values)
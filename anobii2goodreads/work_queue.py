@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""Queue backed workers for the auto_add and update_date backlogs.
+
+Books are put on a queue once, and any number of worker processes, on
+any number of hosts sharing the queue, lease them one at a time:
+
+    anobii2goodreads queue --queue sqlite:///queue.db enqueue-add \\
+        --account alice -a anobii_converted.csv -g goodreads_exported.csv
+    anobii2goodreads queue --queue sqlite:///queue.db work \\
+        --account alice=alice.cookies.json
+    anobii2goodreads queue --queue sqlite:///queue.db status
+
+Leases expire unless the worker heartbeats, so jobs of a stuck or killed
+worker are picked up by another one. The wait between two requests of
+the same account is enforced through the queue, so it holds across all
+workers. `redis://` queues need the `redis` package; `RedisQueue` only
+uses a handful of commands and accepts any client providing them, such as
+the in-process `MemoryRedis` used in tests.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from .auto_add import (add_to_goodreads, dedupe_entries,
+                       get_all_missing_entries, get_all_present_isbns)
+from .records import BookRecord
+from .update_date import get_read_entries, is_done, update_to_goodreads
+from .utils import GOODREADS_URL
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    account TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (account, state, lease_expires);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    account TEXT PRIMARY KEY,
+    next_allowed REAL NOT NULL
+);
+'''
+
+# move the oldest pending job to the leased set in one step, so a worker
+# killed halfway cannot drop it from both
+LEASE_SCRIPT = '''
+local job_id = redis.call('RPOP', KEYS[1])
+if not job_id then
+    return false
+end
+redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+local key = ARGV[3] .. job_id
+redis.call('HSET', key, 'state', 'leased', 'owner', ARGV[2])
+redis.call('HINCRBY', key, 'attempts', 1)
+return job_id
+'''
+
+# move the jobs whose lease expired back to the pending list
+REQUEUE_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('HSET', ARGV[2] .. job_id, 'state', 'pending')
+    redis.call('LPUSH', KEYS[2], job_id)
+end
+return #expired
+'''
+
+
+class SQLiteQueue(object):
+    """Job queue in a SQLite file, shared by processes on one host."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers
+        # can never lease the same job
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def put(self, kind, account, payloads):
+        with self._lock:
+            self._transaction()
+            self.conn.executemany(
+                'INSERT INTO jobs (kind, account, payload) VALUES (?, ?, ?)',
+                [(kind, account, json.dumps(p, ensure_ascii=False))
+                 for p in payloads])
+            self.conn.execute('COMMIT')
+
+    def lease(self, worker, accounts, lease_seconds):
+        """Lease a pending or expired job of ``accounts``, or return None."""
+        now = time.time()
+        with self._lock:
+            self._transaction()
+            row = self.conn.execute(
+                'SELECT id, kind, account, payload FROM jobs '
+                'WHERE account IN ({}) AND (state = \'pending\' OR '
+                '(state = \'leased\' AND lease_expires < ?)) '
+                'ORDER BY id LIMIT 1'.format(', '.join('?' * len(accounts))),
+                list(accounts) + [now]).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    'UPDATE jobs SET state = \'leased\', owner = ?, '
+                    'lease_expires = ?, attempts = attempts + 1 '
+                    'WHERE id = ?', (worker, now + lease_seconds, row[0]))
+            self.conn.execute('COMMIT')
+        if row is None:
+            return None
+        return {'id': row[0], 'kind': row[1], 'account': row[2],
+                'payload': json.loads(row[3])}
+
+    def heartbeat(self, job_id, worker, lease_seconds):
+        with self._lock:
+            self.conn.execute(
+                'UPDATE jobs SET lease_expires = ? '
+                'WHERE id = ? AND owner = ? AND state = \'leased\'',
+                (time.time() + lease_seconds, job_id, worker))
+
+    def complete(self, job_id, worker, state, result):
+        with self._lock:
+            self.conn.execute(
+                'UPDATE jobs SET state = ?, result = ?, lease_expires = NULL '
+                'WHERE id = ? AND owner = ?',
+                (state, result, job_id, worker))
+
+    def acquire_rate(self, account, interval):
+        """Take the account's next request slot; return seconds to wait."""
+        now = time.time()
+        with self._lock:
+            self._transaction()
+            row = self.conn.execute(
+                'SELECT next_allowed FROM rate_limits WHERE account = ?',
+                (account,)).fetchone()
+            wait = 0.0 if row is None else max(0.0, row[0] - now)
+            if wait == 0:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO rate_limits VALUES (?, ?)',
+                    (account, now + interval))
+            self.conn.execute('COMMIT')
+        return wait
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT account, kind, state, COUNT(*) FROM jobs '
+                'GROUP BY account, kind, state').fetchall()
+        return [tuple(row) for row in rows]
+
+
+class RedisQueue(object):
+    """Job queue on a Redis compatible server, shared across hosts.
+
+    Uses the ``incr``, ``hset``, ``hgetall``, ``lpush``, ``zadd``, ``zrem``,
+    ``set(nx, px)``, ``pttl``, ``keys`` and ``register_script`` commands of
+    a redis-py style client. Leasing and requeueing run as Lua scripts, so
+    a job is always either pending or leased.
+    """
+
+    def __init__(self, client, prefix='anobii2goodreads'):
+        self.client = client
+        self.prefix = prefix
+        self._lease_script = client.register_script(LEASE_SCRIPT)
+        self._requeue_script = client.register_script(REQUEUE_SCRIPT)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def put(self, kind, account, payloads):
+        for payload in payloads:
+            job_id = str(self.client.incr(self._key('next_id')))
+            self.client.hset(self._key('job', job_id), mapping={
+                'kind': kind,
+                'account': account,
+                'payload': json.dumps(payload, ensure_ascii=False),
+                'state': 'pending',
+                'attempts': 0,
+            })
+            self.client.lpush(self._key('pending', account), job_id)
+
+    def lease(self, worker, accounts, lease_seconds):
+        for account in accounts:
+            pending = self._key('pending', account)
+            leased = self._key('leased', account)
+            self._requeue_script(keys=[leased, pending],
+                                 args=[time.time(), self._key('job', '')])
+            job_id = self._lease_script(
+                keys=[pending, leased],
+                args=[time.time() + lease_seconds, worker,
+                      self._key('job', '')])
+            if job_id is None:
+                continue
+            job_id = _text(job_id)
+            job = self._job(job_id)
+            return {'id': job_id, 'kind': job['kind'], 'account': account,
+                    'payload': json.loads(job['payload'])}
+        return None
+
+    def _job(self, job_id):
+        return {_text(k): _text(v) for k, v in self.client.hgetall(
+            self._key('job', str(job_id))).items()}
+
+    def heartbeat(self, job_id, worker, lease_seconds):
+        job = self._job(job_id)
+        if job.get('owner') == worker and job.get('state') == 'leased':
+            self.client.zadd(self._key('leased', job['account']),
+                             {str(job_id): time.time() + lease_seconds})
+
+    def complete(self, job_id, worker, state, result):
+        key = self._key('job', str(job_id))
+        job = self._job(job_id)
+        # a worker whose lease expired may no longer own the job
+        if job.get('owner') != worker:
+            return
+        self.client.zrem(self._key('leased', job['account']), str(job_id))
+        self.client.hset(key, mapping={'state': state, 'result': result})
+
+    def acquire_rate(self, account, interval):
+        key = self._key('rate', account)
+        if self.client.set(key, worker_id(), nx=True,
+                           px=max(1, int(interval * 1000))):
+            return 0.0
+        return max(0.0, self.client.pttl(key) / 1000.0)
+
+    def counts(self):
+        counter = {}
+        for key in self.client.keys(self._key('job', '*')):
+            job = self._job(_text(key).rsplit(':', 1)[1])
+            group = (job['account'], job['kind'], job['state'])
+            counter[group] = counter.get(group, 0) + 1
+        return [group + (count,) for group, count in sorted(counter.items())]
+
+
+def _text(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+class MemoryRedis(object):
+    """In-process stand-in for the Redis commands used by RedisQueue.
+
+    Only shared between threads of one process, so it is meant for tests
+    and load tests rather than for the command line. The two Lua scripts
+    of RedisQueue are run as Python under the lock.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self._lock = threading.RLock()
+        self._scripts = {
+            LEASE_SCRIPT: self._lease,
+            REQUEUE_SCRIPT: self._requeue,
+        }
+
+    def _expire(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            del self.expires[key]
+            self.data.pop(key, None)
+
+    def register_script(self, script):
+        run = self._scripts[script]
+
+        def call(keys, args):
+            with self._lock:
+                return run(keys, args)
+
+        return call
+
+    def _lease(self, keys, args):
+        job_id = self.rpop(keys[0])
+        if job_id is None:
+            return None
+        self.zadd(keys[1], {job_id: args[0]})
+        job = self.data.setdefault(args[2] + job_id, {})
+        job.update({'state': 'leased', 'owner': args[1],
+                    'attempts': str(int(job.get('attempts', 0)) + 1)})
+        return job_id
+
+    def _requeue(self, keys, args):
+        expired = self.zrangebyscore(keys[0], float('-inf'), args[0])
+        for job_id in expired:
+            self.zrem(keys[0], job_id)
+            self.hset(args[1] + job_id, {'state': 'pending'})
+            self.lpush(keys[1], job_id)
+        return len(expired)
+
+    def incr(self, key):
+        with self._lock:
+            self.data[key] = int(self.data.get(key, 0)) + 1
+            return self.data[key]
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self.data.setdefault(key, {}).update(
+                {k: str(v) for k, v in mapping.items()})
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self.data.get(key, {}))
+
+    def lpush(self, key, value):
+        with self._lock:
+            self.data.setdefault(key, []).insert(0, value)
+
+    def rpop(self, key):
+        with self._lock:
+            values = self.data.get(key)
+            return values.pop() if values else None
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            self.data.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, low, high):
+        with self._lock:
+            return sorted((m for m, s in self.data.get(key, {}).items()
+                           if low <= s <= high),
+                          key=lambda m: self.data[key][m])
+
+    def zrem(self, key, member):
+        with self._lock:
+            return 0 if self.data.get(key, {}).pop(member, None) is None else 1
+
+    def set(self, key, value, nx=False, px=None):
+        with self._lock:
+            self._expire(key)
+            if nx and key in self.data:
+                return None
+            self.data[key] = value
+            if px is not None:
+                self.expires[key] = time.time() + px / 1000.0
+            return True
+
+    def pttl(self, key):
+        with self._lock:
+            self._expire(key)
+            if key not in self.expires:
+                return -1
+            return int((self.expires[key] - time.time()) * 1000)
+
+    def keys(self, pattern):
+        prefix = pattern.rstrip('*')
+        with self._lock:
+            return [k for k in self.data if k.startswith(prefix)]
+
+
+def open_queue(url):
+    """Open a queue from ``sqlite:///path`` or ``redis://host:port/db``."""
+    if url.startswith('sqlite:///'):
+        return SQLiteQueue(url[len('sqlite:///'):])
+    if url.startswith('redis://'):
+        import redis
+
+        return RedisQueue(redis.Redis.from_url(url))
+    raise ValueError('unsupported queue: {}'.format(url))
+
+
+def worker_id():
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(),
+                             uuid.uuid4().hex[:8])
+
+
+class Heartbeat(threading.Thread):
+    """Extend the lease of the current job until stopped."""
+
+    def __init__(self, queue, job_id, worker, lease_seconds):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3.0):
+            self.queue.heartbeat(self.job_id, self.worker, self.lease_seconds)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def process_job(job, cookies, base_url=GOODREADS_URL, disk_cache=None):
+    """Run one job; return its final state and a short result.
+
+    ``disk_cache`` is the update_date cache of updated books; without one,
+    update jobs are always run.
+    """
+    entry = BookRecord.from_dict(job['payload'])
+    if job['kind'] == 'add':
+        success, duplicate = add_to_goodreads([entry], cookies, base_url,
+                                              wait=0)
+        if success:
+            return 'done', 'added'
+        if duplicate:
+            return 'done', 'duplicate'
+        return 'failed', 'error'
+    if disk_cache is None:
+        disk_cache = {}
+    elif is_done(entry, disk_cache, False):
+        return 'done', 'already updated'
+    success, _ = update_to_goodreads([entry], cookies, disk_cache, None, 0,
+                                     base_url)
+    return ('done', 'updated') if success else ('failed', 'error')
+
+
+def work(queue, cookies_by_account, interval, lease_seconds, idle_exit,
+         base_url=GOODREADS_URL, disk_cache=None):
+    """Lease and process jobs until the queue stays empty."""
+    worker = worker_id()
+    accounts = sorted(cookies_by_account)
+    idle_since = None
+    while True:
+        job = queue.lease(worker, accounts, lease_seconds)
+        if job is None:
+            idle_since = idle_since or time.time()
+            if time.time() - idle_since >= idle_exit:
+                logging.info('queue is empty, worker %s exits', worker)
+                return
+            time.sleep(1)
+            continue
+        idle_since = None
+
+        # keep the lease while waiting for the account's next slot, too
+        heartbeat = Heartbeat(queue, job['id'], worker, lease_seconds)
+        heartbeat.start()
+        try:
+            # one global pace per account, however many workers there are
+            wait = queue.acquire_rate(job['account'], interval)
+            while wait > 0:
+                time.sleep(wait)
+                wait = queue.acquire_rate(job['account'], interval)
+
+            state, result = process_job(job,
+                                        cookies_by_account[job['account']],
+                                        base_url, disk_cache)
+        except Exception as e:
+            logging.exception('job %s failed', job['id'])
+            state, result = 'failed', repr(e)
+        finally:
+            heartbeat.stop()
+        queue.complete(job['id'], worker, state, result)
+        logging.info('job %s (%s/%s): %s', job['id'], job['account'],
+                     job['kind'], result)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Queue backed workers for adding and updating books.')
+    parser.add_argument('--queue',
+                        default='sqlite:///queue.db',
+                        help='sqlite:///PATH or redis://HOST:PORT/DB')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    add = commands.add_parser('enqueue-add', help='Queue books to add.')
+    add.add_argument('--account', required=True, help='Account name.')
+    add.add_argument('-a',
+                     '--anobii-converted-csv',
+                     help='aNobii CSV file converted by anobii2goodreads.py',
+                     required=True)
+    add.add_argument('-g',
+                     '--goodreads-csv',
+                     help='Goodreads CSV export file to compare differences',
+                     required=True)
+
+    update = commands.add_parser('enqueue-update',
+                                 help='Queue books to update dates.')
+    update.add_argument('--account', required=True, help='Account name.')
+    update.add_argument('-b',
+                        '--books',
+                        help='Book items produced by scrapy.',
+                        required=True)
+    update.add_argument('-d',
+                        '--disk-cache',
+                        help='Cache file to record updated items.',
+                        required=True)
+    update.add_argument('--skip-error',
+                        action='store_true',
+                        help='Skip error items')
+
+    worker = commands.add_parser('work', help='Process queued books.')
+    worker.add_argument('--account',
+                        action='append',
+                        required=True,
+                        metavar='NAME=COOKIE_JSON',
+                        help='Account to work for, with its cookie file.')
+    worker.add_argument('--wait',
+                        type=float,
+                        default=5,
+                        help='Seconds between books of the same account.')
+    worker.add_argument('--lease',
+                        type=float,
+                        default=120,
+                        help='Seconds before a silent worker loses a job.')
+    worker.add_argument('--idle-exit',
+                        type=float,
+                        default=10,
+                        help='Exit after the queue was empty this long.')
+    worker.add_argument('-d',
+                        '--disk-cache',
+                        help='Cache file to record updated items, shared '
+                        'with update-date and the workers on this host.')
+    worker.add_argument('--goodreads-url',
+                        default=GOODREADS_URL,
+                        help='Goodreads URL, e.g. a local stand-in server.')
+
+    commands.add_parser('status', help='Show job counts.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    queue = open_queue(args.queue)
+
+    if args.command == 'enqueue-add':
+        all_isbns = get_all_present_isbns(args.goodreads_csv)
+        entries, skipped = get_all_missing_entries(args.anobii_converted_csv,
+                                                   all_isbns=all_isbns)
+        entries, merged = dedupe_entries(entries)
+        queue.put('add', args.account, [e.to_dict() for e in entries])
+        logging.info('== %d entries queued, %d skipped, %d merged ==',
+                     len(entries), len(skipped), merged)
+    elif args.command == 'enqueue-update':
+        import diskcache as dc
+
+        with dc.Cache(args.disk_cache) as disk_cache:
+            entries = list(get_read_entries(args.books, disk_cache,
+                                            args.skip_error))
+        queue.put('update', args.account, [e.to_dict() for e in entries])
+        logging.info('== %d entries queued ==', len(entries))
+    elif args.command == 'work':
+        cookies_by_account = {}
+        for value in args.account:
+            name, path = value.split('=', 1)
+            with open(path, encoding='utf8') as f:
+                cookies_by_account[name] = json.load(f)
+        disk_cache = None
+        if args.disk_cache:
+            import diskcache as dc
+
+            disk_cache = dc.Cache(args.disk_cache)
+        try:
+            work(queue, cookies_by_account, args.wait, args.lease,
+                 args.idle_exit, args.goodreads_url, disk_cache)
+        finally:
+            if disk_cache is not None:
+                disk_cache.close()
+    else:
+        for account, kind, state, count in queue.counts():
+            print('{:<16} {:<8} {:<8} {:>6}'.format(account, kind, state,
+                                                    count))
+
+
+if __name__ == '__main__':
+    main()
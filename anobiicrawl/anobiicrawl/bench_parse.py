@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Benchmark ProgressSpider callbacks over a recorded corpus.
+
+Record a corpus first with `scrapy crawl progress ... -s CORPUS_MODE=record`,
+then run:
+
+    python3 -m anobiicrawl.bench_parse --corpus corpus --repeat 5
+"""
+import argparse
+import collections
+import gzip
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from scrapy.http import Headers, Request
+from scrapy.responsetypes import responsetypes
+
+from anobiicrawl.middlewares import iter_corpus
+from anobiicrawl.spiders.progress import ProgressSpider
+
+
+def decode_body(headers, body):
+    """Undo the Content-Encoding the corpus was recorded with."""
+    encoding = headers.get(b'Content-Encoding')
+    if encoding is not None:
+        del headers[b'Content-Encoding']
+    if encoding == b'gzip':
+        return gzip.decompress(body)
+    if encoding == b'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # raw deflate stream
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def build_responses(corpus_dir):
+    """Turn corpus entries into (request_type, response) pairs."""
+    responses = []
+    for entry in iter_corpus(corpus_dir):
+        request_type = entry['meta'].get('request_type')
+        if request_type not in ('shelf', 'book', 'progress'):
+            continue
+        request = Request(entry['url'], meta=entry['meta'])
+        headers = Headers(entry['headers'])
+        body = decode_body(headers, entry['body'])
+        respcls = responsetypes.from_args(headers=headers,
+                                          url=entry['url'],
+                                          body=body)
+        responses.append((request_type, respcls(url=entry['url'],
+                                                status=entry['status'],
+                                                headers=headers,
+                                                body=body,
+                                                request=request)))
+    return responses
+
+
+def new_spider(work_dir):
+    """A spider with empty caches, so every pass does the same work."""
+    work_dir = tempfile.mkdtemp(dir=work_dir)
+    spider = ProgressSpider(visited=os.path.join(work_dir, 'visited'),
+                            user='bench', login_path=None,
+                            failed=os.path.join(work_dir, 'failed'))
+    # keep spider logging out of the measurement
+    spider.logger.logger.setLevel(logging.ERROR)
+    # the visited cache is written when the spider closes, outside the
+    # measurement
+    spider.visited_flush_size = float('inf')
+    return spider
+
+
+def run(work_dir, responses, repeat):
+    elapsed = collections.Counter()
+    pages = collections.Counter()
+    for _ in range(repeat):
+        spider = new_spider(work_dir)
+        callbacks = {
+            'shelf': spider.parse,
+            'book': spider.parse_book,
+            'progress': spider.parse_progress,
+        }
+        try:
+            for request_type, response in responses:
+                start = time.perf_counter()
+                for _ in callbacks[request_type](response):
+                    pass
+                elapsed[request_type] += time.perf_counter() - start
+                pages[request_type] += 1
+        finally:
+            spider.closed('finished')
+    return elapsed, pages
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the progress spider parsers offline.')
+    parser.add_argument('--corpus',
+                        default='corpus',
+                        help='Corpus directory recorded by CorpusMiddleware.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of passes over the corpus.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    responses = build_responses(args.corpus)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        elapsed, pages = run(work_dir, responses, args.repeat)
+
+    for request_type in ('shelf', 'book', 'progress'):
+        if pages[request_type]:
+            logging.info('%-8s %6d pages %8.3fs %10.1f pages/sec',
+                         request_type, pages[request_type],
+                         elapsed[request_type],
+                         pages[request_type] / max(elapsed[request_type],
+                                                   1e-9))
+    total = sum(elapsed.values())
+    logging.info('%-8s %6d pages %8.3fs %10.1f pages/sec', 'total',
+                 sum(pages.values()), total,
+                 sum(pages.values()) / max(total, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
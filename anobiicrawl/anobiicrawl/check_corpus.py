@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Check that a recorded corpus replays the whole crawl offline.
+
+Crawls the local mock server with `CORPUS_MODE=record`, stops the server,
+crawls again with `CORPUS_MODE=replay` and compares the items:
+
+    cd anobiicrawl/
+    python3 -m anobiicrawl.check_corpus --books 100
+
+Exits with status 1 when the replay misses or adds books.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from anobiicrawl.mock_server import MockAnobiiServer
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def crawl(work_dir, name, base_url, corpus_dir, mode):
+    """Run the progress spider and return the ISBN-13s it scraped."""
+    output = os.path.join(work_dir, name + '.jl')
+    login_path = os.path.join(work_dir, 'login.json')
+    with open(login_path, 'w', encoding='utf8') as f:
+        json.dump({'email': 'mock', 'password': 'mock'}, f)
+    subprocess.run([
+        sys.executable, '-m', 'scrapy', 'crawl', 'progress',
+        '-a', 'visited=' + os.path.join(work_dir, name + '_visited'),
+        '-a', 'user=mock',
+        '-a', 'login_path=' + login_path,
+        '-a', 'base_url=' + base_url,
+        '-s', 'CRAWL_PROFILE=fast',
+        '-s', 'ROBOTSTXT_OBEY=0',
+        '-s', 'LOG_LEVEL=WARNING',
+        '-s', 'CORPUS_MODE=' + mode,
+        '-s', 'CORPUS_DIR=' + corpus_dir,
+        '-o', output,
+    ], cwd=PROJECT_DIR, check=True)
+    with open(output, encoding='utf8') as f:
+        return {json.loads(line)['isbn13'] for line in f if line.strip()}
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Check that a recorded corpus replays the whole crawl.')
+    parser.add_argument('--books',
+                        type=int,
+                        default=100,
+                        help='Number of books on the mock shelf.')
+    parser.add_argument('--no-shelf-item-ids',
+                        dest='shelf_item_ids',
+                        action='store_false',
+                        help='Go through the book pages as well.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = MockAnobiiServer(('127.0.0.1', 0), args.books, 0,
+                              args.shelf_item_ids)
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_dir = os.path.join(work_dir, 'corpus')
+        try:
+            recorded = crawl(work_dir, 'record', base_url, corpus_dir,
+                             'record')
+        finally:
+            # the replay must not need the network
+            server.shutdown()
+            server.server_close()
+        replayed = crawl(work_dir, 'replay', base_url, corpus_dir, 'replay')
+
+    logging.info('recorded %d books, replayed %d', len(recorded),
+                 len(replayed))
+    if len(recorded) != args.books or replayed != recorded:
+        logging.error('missing from replay: %d, only in replay: %d',
+                      len(recorded - replayed), len(replayed - recorded))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
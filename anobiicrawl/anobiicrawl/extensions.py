@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+import bisect
+import collections
+import json
+import os
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+# upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def to_dict(self):
+        count = sum(self.counts)
+        buckets = ['<={}'.format(b) for b in LATENCY_BUCKETS] + ['>60']
+        return {
+            'count': count,
+            'mean': self.total / count if count else None,
+            'max': self.max,
+            'buckets': dict(zip(buckets, self.counts)),
+        }
+
+
+class CrawlMetrics(object):
+    """Write crawl metrics to a JSON file, periodically and on close.
+
+    Records latency histograms and downloaded bytes per request type
+    (``meta['request_type']``), items per minute, scheduler queue depth and
+    the delay of every download slot over time.
+    """
+
+    def __init__(self, crawler, path, interval):
+        self.crawler = crawler
+        self.path = path
+        self.interval = interval
+        self.latency = collections.defaultdict(LatencyHistogram)
+        self.bytes = collections.Counter()
+        self.items = 0
+        self.delays = []
+        self.started = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('METRICS_PATH')
+        if not path:
+            raise NotConfigured
+        ext = cls(crawler, path, crawler.settings.getfloat('METRICS_INTERVAL'))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received,
+                                signal=signals.response_received)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.started = time.time()
+        self.task = task.LoopingCall(self.write_snapshot, spider, False)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.write_snapshot(spider, True, reason)
+
+    def response_received(self, response, request, spider):
+        request_type = request.meta.get('request_type', 'other')
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.latency[request_type].add(latency)
+        self.bytes[request_type] += len(response.body)
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def _queue_depth(self):
+        engine = self.crawler.engine
+        # renamed to _slot in newer Scrapy versions
+        slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+        if slot is None:
+            return None
+        return len(slot.scheduler)
+
+    def _slot_delays(self):
+        slots = self.crawler.engine.downloader.slots
+        return {key: slot.delay for key, slot in slots.items()}
+
+    def write_snapshot(self, spider, final, reason=None):
+        now = time.time()
+        elapsed = now - self.started
+        self.delays.append({'elapsed': elapsed,
+                            'delays': self._slot_delays()})
+        snapshot = {
+            'spider': spider.name,
+            'final': final,
+            'reason': reason,
+            'elapsed': elapsed,
+            'items': self.items,
+            'items_per_minute': self.items * 60 / max(elapsed, 1e-9),
+            'queue_depth': self._queue_depth(),
+            'in_progress': len(self.crawler.engine.downloader.active),
+            'bytes': dict(self.bytes),
+            'latency': {request_type: histogram.to_dict()
+                        for request_type, histogram in self.latency.items()},
+            'slot_delays': self.delays,
+        }
+        # write atomically so readers never see a partial snapshot
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, self.path)
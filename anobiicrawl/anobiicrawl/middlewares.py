@@ -5,7 +5,16 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import base64
+import gzip
+import hashlib
+import json
+import os
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
 
 
 class AnobiicrawlSpiderMiddleware(object):
@@ -54,3 +63,186 @@ class AnobiicrawlSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class CrawlProfileMiddleware(object):
+    """Route each request type to its own download slot.
+
+    The spider tags requests with ``meta['request_type']`` (``shelf``,
+    ``book`` or ``progress``). Every type gets a dedicated slot whose
+    concurrency and delay come from the active ``CRAWL_PROFILE``, and whose
+    delay is then throttled separately towards the profile's target
+    concurrency, the same way AutoThrottle does for a whole domain.
+    """
+
+    def __init__(self, crawler, profile):
+        self.crawler = crawler
+        self.profile = profile
+        self.max_delay = crawler.settings.getfloat('AUTOTHROTTLE_MAX_DELAY')
+        self.debug = crawler.settings.getbool('AUTOTHROTTLE_DEBUG')
+        # slot key -> slot whose concurrency and delay are set already; the
+        # downloader drops idle slots and creates new ones later
+        self.configured_slots = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        name = crawler.settings.get('CRAWL_PROFILE')
+        if not name:
+            raise NotConfigured
+        profiles = crawler.settings.getdict('CRAWL_PROFILES')
+        if name not in profiles:
+            raise ValueError('unknown crawl profile: {}'.format(name))
+        return cls(crawler, profiles[name])
+
+    def _slot_key(self, request):
+        request_type = request.meta.get('request_type')
+        if request_type in self.profile['slots']:
+            return 'anobii-{}'.format(request_type)
+        return None
+
+    def _configure_slot(self, request):
+        key = self._slot_key(request)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None or self.configured_slots.get(key) is slot:
+            return
+        conf = self.profile['slots'][request.meta['request_type']]
+        slot.concurrency = conf['concurrency']
+        slot.delay = conf['delay']
+        self.configured_slots[key] = slot
+
+    def process_request(self, request, spider):
+        key = self._slot_key(request)
+        if key is not None:
+            request.meta.setdefault('download_slot', key)
+            # the slot only exists after its first request was enqueued
+            self._configure_slot(request)
+
+    def process_response(self, request, response, spider):
+        key = self._slot_key(request)
+        latency = request.meta.get('download_latency')
+        if key is None or latency is None:
+            return response
+        self._configure_slot(request)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return response
+
+        conf = self.profile['slots'][request.meta['request_type']]
+        target_delay = latency / conf['target_concurrency']
+        new_delay = max(target_delay, (slot.delay + target_delay) / 2.0)
+        new_delay = min(max(conf['delay'], new_delay), self.max_delay)
+        # only allow non-200 responses to increase the delay
+        if response.status != 200 and new_delay <= slot.delay:
+            return response
+
+        if self.debug:
+            spider.logger.info('[%s] delay: %.2f -> %.2f, latency: %.2f',
+                               key, slot.delay, new_delay, latency)
+        slot.delay = new_delay
+        return response
+
+
+def apply_crawl_profile(settings):
+    """Set global limits so that the per-slot profile is not capped.
+
+    Called from ``Spider.update_settings`` since settings are frozen by the
+    time middlewares are created.
+    """
+    name = settings.get('CRAWL_PROFILE')
+    if not name:
+        return
+    profile = settings.getdict('CRAWL_PROFILES')[name]
+    concurrency = sum(conf['concurrency']
+                      for conf in profile['slots'].values())
+    settings.set('CONCURRENT_REQUESTS', concurrency, priority='spider')
+    # per-slot throttling is done by CrawlProfileMiddleware instead
+    settings.set('AUTOTHROTTLE_ENABLED', False, priority='spider')
+
+
+# request meta kept in the corpus so that callbacks can be replayed
+CORPUS_META = ('request_type', 'isbn13', 'title', 'fingerprint', 'book_url')
+
+
+def corpus_key(request):
+    digest = hashlib.sha1()
+    for part in (request.method, request.url):
+        digest.update(part.encode('utf8'))
+    digest.update(request.body or b'')
+    return digest.hexdigest()
+
+
+def load_corpus_entry(path):
+    with gzip.open(path, 'rt', encoding='utf8') as f:
+        entry = json.load(f)
+    entry['body'] = base64.b64decode(entry['body'])
+    return entry
+
+
+def iter_corpus(corpus_dir):
+    """Yield every recorded response in ``corpus_dir``."""
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.endswith('.json.gz'):
+            yield load_corpus_entry(os.path.join(corpus_dir, name))
+
+
+class CorpusMiddleware(object):
+    """Record responses to a gzipped corpus, or replay them offline.
+
+    With ``CORPUS_MODE = 'record'`` every response is saved under
+    ``CORPUS_DIR``; with ``'replay'`` requests are answered from it without
+    touching the network (and without any download delay), and requests
+    that were never recorded are dropped.
+    """
+
+    def __init__(self, corpus_dir, mode):
+        self.corpus_dir = corpus_dir
+        self.mode = mode
+        os.makedirs(corpus_dir, exist_ok=True)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mode = crawler.settings.get('CORPUS_MODE')
+        if not mode:
+            raise NotConfigured
+        if mode not in ('record', 'replay'):
+            raise ValueError('unknown corpus mode: {}'.format(mode))
+        return cls(crawler.settings.get('CORPUS_DIR'), mode)
+
+    def _path(self, request):
+        return os.path.join(self.corpus_dir,
+                            corpus_key(request) + '.json.gz')
+
+    def process_request(self, request, spider):
+        if self.mode != 'replay':
+            return None
+        path = self._path(request)
+        if not os.path.exists(path):
+            raise IgnoreRequest('not in corpus: {}'.format(request.url))
+        entry = load_corpus_entry(path)
+        headers = Headers(entry['headers'])
+        respcls = responsetypes.from_args(headers=headers,
+                                          url=entry['url'],
+                                          body=entry['body'])
+        return respcls(url=entry['url'],
+                       status=entry['status'],
+                       headers=headers,
+                       body=entry['body'],
+                       request=request)
+
+    def process_response(self, request, response, spider):
+        if self.mode != 'record':
+            return response
+        entry = {
+            'url': response.url,
+            'method': request.method,
+            'status': response.status,
+            'headers': {key.decode('latin1'): [v.decode('latin1')
+                                               for v in values]
+                        for key, values in response.headers.items()},
+            'meta': {key: request.meta[key] for key in CORPUS_META
+                     if key in request.meta},
+            'body': base64.b64encode(response.body).decode('ascii'),
+        }
+        with gzip.open(self._path(request), 'wt', encoding='utf8') as f:
+            json.dump(entry, f)
+        return response
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""A local stand-in for aNobii used to benchmark the progress spider.
+
+Serves the login page, public bookshelf pages, book pages and the
+``personal_book_reading`` JSON endpoint for a synthetic shelf:
+
+    python3 -m anobiicrawl.mock_server --books 3000 --latency 0.2
+    scrapy crawl progress -a base_url=http://127.0.0.1:8000 ... \\
+        -s CRAWL_PROFILE=fast -s ROBOTSTXT_OBEY=0
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+PAGE_SIZE = 20
+
+LOGIN_PAGE = '''<html><body>
+<form id="login-nav" method="post" action="/login">
+<input type="text" name="email" value=""/>
+<input type="password" name="password" value=""/>
+</form>
+</body></html>'''
+
+
+def isbn13_for(index):
+    """Return a stable, valid ISBN-13 for the synthetic book ``index``."""
+    digits = '978{:09d}'.format(index)
+    total = sum(int(d) * (1 if i % 2 == 0 else 3)
+                for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+def item_id_for(index):
+    return str(100000 + index)
+
+
+def shelf_page(user, page, num_books, shelf_item_ids=True):
+    start = (page - 1) * PAGE_SIZE
+    rows = []
+    for index in range(start, min(start + PAGE_SIZE, num_books)):
+        item_id = item_id_for(index)
+        rows.append('<tr class="item" id="enc{index}"{data}><td>'
+                    '<a href="/books/Book_{index}/{isbn13}/{item_id}/">'
+                    'Book {index}</a></td>'
+                    '<td>Finished reading on Jan 15, {year}</td></tr>'.format(
+                        index=index,
+                        data=(' data-item-id="{}"'.format(item_id)
+                              if shelf_item_ids else ''),
+                        isbn13=isbn13_for(index),
+                        year=2001 + index % 20,
+                        item_id=item_id))
+    # like aNobii, only show a window of page links around the current one
+    num_pages = (num_books + PAGE_SIZE - 1) // PAGE_SIZE
+    link = ('<a class="{cls}" href="/book_shelf_public_ajax'
+            '?personId={user}&page={page}">{text}</a>')
+    links = [link.format(cls='page', user=user, page=p, text=p)
+             for p in range(max(1, page - 4), min(num_pages, page + 4) + 1)]
+    if page < num_pages:
+        links.append(link.format(cls='next', user=user, page=page + 1,
+                                 text='next'))
+    return ('<html><body><table>{}</table>'
+            '<p class="pagination_wrap">{}</p></body></html>'.format(
+                ''.join(rows), ''.join(links)))
+
+
+def book_page(item_id):
+    return ('<html><body><input class="item_id" value="{}"/>'
+            '</body></html>'.format(item_id))
+
+
+def progress_json(item_id):
+    index = int(item_id) - 100000
+    year = 2000 + index % 20
+    return json.dumps({'readingProgress': [{
+        'startaa': str(year),
+        'startmm': '{:02d}'.format(index % 12 + 1),
+        'startgg': '{:02d}'.format(index % 28 + 1),
+        'endaa': str(year + 1),
+        'endmm': '01',
+        'endgg': '15',
+    }]})
+
+
+class MockAnobiiHandler(BaseHTTPRequestHandler):
+
+    def _send(self, body, content_type='text/html; charset=utf-8',
+              status=200):
+        data = body.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip('/').split('/')
+
+        if url.path == '/robots.txt':
+            self._send('', content_type='text/plain')
+        elif url.path in ('/', '/login'):
+            self._send(LOGIN_PAGE)
+        elif url.path == '/book_shelf_public_ajax':
+            user = query.get('personId', [''])[0]
+            page = int(query.get('page', ['1'])[0])
+            self._send(shelf_page(user, page, server.num_books,
+                                  server.shelf_item_ids))
+        elif len(path) == 5 and path[1] == 'books':
+            self._send(book_page(path[4]))
+        elif (len(path) == 6 and
+              path[1:4] == ['anobiireload', 'c3', 'personal_book_reading']):
+            self._send(progress_json(path[4]),
+                       content_type='application/json')
+        else:
+            self._send('not found', status=404)
+        server.count_request()
+
+    def do_POST(self):
+        # login: accept anything and go back to the front page
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(302)
+        self.send_header('Location', '/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.count_request()
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class MockAnobiiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, num_books, latency, shelf_item_ids=True):
+        super(MockAnobiiServer, self).__init__(address, MockAnobiiHandler)
+        self.num_books = num_books
+        self.latency = latency
+        self.shelf_item_ids = shelf_item_ids
+        self.num_requests = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.num_requests += 1
+
+    def report(self):
+        elapsed = time.time() - self.started
+        logging.info('%d requests in %.1fs (%.2f requests/sec)',
+                     self.num_requests, elapsed,
+                     self.num_requests / max(elapsed, 1e-9))
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Serve a synthetic aNobii shelf for benchmarking.')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address.')
+    parser.add_argument('--port', type=int, default=8000, help='Bind port.')
+    parser.add_argument('--books',
+                        type=int,
+                        default=1000,
+                        help='Number of books on the shelf.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='Average seconds to wait before responding.')
+    parser.add_argument('--no-shelf-item-ids',
+                        dest='shelf_item_ids',
+                        action='store_false',
+                        help='Omit item_ids from shelf rows, so the spider '
+                        'has to visit every book page.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = MockAnobiiServer((args.host, args.port), args.books,
+                              args.latency, args.shelf_item_ids)
+    logging.info('serving %d books on http://%s:%d', args.books, args.host,
+                 args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.report()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
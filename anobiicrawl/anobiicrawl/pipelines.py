@@ -4,8 +4,134 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import json
+import os
+import sqlite3
+
+from scrapy.exceptions import NotConfigured
+
+SESSION_FIELDS = ('startaa', 'startmm', 'startgg', 'endaa', 'endmm', 'endgg')
+
+# written next to the feed when the crawl ends, see `update_date --follow`
+DONE_SUFFIX = '.done'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    isbn13 TEXT PRIMARY KEY,
+    title TEXT,
+    progress TEXT
+);
+CREATE TABLE IF NOT EXISTS reading_sessions (
+    isbn13 TEXT NOT NULL REFERENCES books(isbn13),
+    seq INTEGER NOT NULL,
+    startaa TEXT, startmm TEXT, startgg TEXT,
+    endaa TEXT, endmm TEXT, endgg TEXT,
+    PRIMARY KEY (isbn13, seq)
+);
+'''
 
 
 class AnobiicrawlPipeline(object):
     def process_item(self, item, spider):
         return item
+
+
+class JsonLinesFeedPipeline(object):
+    """Append ProgressItems to a JSON lines file as soon as they are scraped.
+
+    Unlike the `-o` feed export, every item is flushed right away, and a
+    ``<path>.done`` marker is written when the crawl ends, so that
+    ``update_date.py --follow`` can process books while the crawl runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done_path = path + DONE_SUFFIX
+        self.file = None
+        self.count = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('PROGRESS_FEED_PATH')
+        if not path:
+            raise NotConfigured
+        return cls(path)
+
+    def open_spider(self, spider):
+        if os.path.exists(self.done_path):
+            os.remove(self.done_path)
+        self.file = open(self.path, 'a', encoding='utf8')
+
+    def close_spider(self, spider):
+        self.file.close()
+        with open(self.done_path, 'w', encoding='utf8') as f:
+            f.write('{}\n'.format(self.count))
+
+    def process_item(self, item, spider):
+        self.file.write(json.dumps(dict(item), ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.count += 1
+        return item
+
+
+class SQLitePipeline(object):
+    """Store ProgressItems in SQLite, one transaction per batch.
+
+    Books are upserted on isbn13 and their reading sessions are kept in the
+    ``reading_sessions`` table, which ``update_date.py --books-db`` reads.
+    """
+
+    def __init__(self, path, batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch = []
+        self.conn = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('SQLITE_PATH')
+        if not path:
+            raise NotConfigured
+        return cls(path, crawler.settings.getint('SQLITE_BATCH_SIZE', 100))
+
+    def open_spider(self, spider):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+
+    def close_spider(self, spider):
+        self.flush()
+        self.conn.close()
+
+    def process_item(self, item, spider):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        if not self.batch:
+            return
+        books = []
+        sessions = []
+        # keep only the latest item if a book was crawled twice
+        latest = {item['isbn13']: item for item in self.batch}
+        for item in latest.values():
+            progress = item.get('progress') or {}
+            books.append((item['isbn13'], item['title'],
+                          json.dumps(progress, ensure_ascii=False)))
+            for seq, session in enumerate(progress.get('readingProgress')
+                                          or []):
+                sessions.append((item['isbn13'], seq) + tuple(
+                    session.get(name) or '' for name in SESSION_FIELDS))
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO books (isbn13, title, progress) '
+                'VALUES (?, ?, ?)', books)
+            self.conn.executemany(
+                'DELETE FROM reading_sessions WHERE isbn13 = ?',
+                [(book[0],) for book in books])
+            self.conn.executemany(
+                'INSERT INTO reading_sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                sessions)
+        self.batch = []
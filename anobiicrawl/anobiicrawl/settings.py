@@ -21,6 +21,10 @@ NEWSPIDER_MODULE = 'anobiicrawl.spiders'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
+# Per-book messages and every scraped item are logged at DEBUG, see them
+# with `-s LOG_LEVEL=DEBUG`
+LOG_LEVEL = 'INFO'
+
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 CONCURRENT_REQUESTS = 1
 
@@ -52,21 +56,77 @@ CONCURRENT_REQUESTS_PER_DOMAIN = 1
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'anobiicrawl.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'anobiicrawl.middlewares.CrawlProfileMiddleware': 543,
+    # above RedirectMiddleware (600), so redirects such as the one after
+    # the login POST are recorded and replayed hop by hop
+    'anobiicrawl.middlewares.CorpusMiddleware': 650,
+}
+
+# Record responses with `-s CORPUS_MODE=record`, and crawl them offline at
+# full speed with `-s CORPUS_MODE=replay`.
+CORPUS_MODE = None
+CORPUS_DIR = 'corpus'
+
+# Named crawl profiles, select one with `-s CRAWL_PROFILE=balanced`.
+# Every request type (shelf, book, progress) gets its own download slot
+# with its own concurrency, minimum delay and AutoThrottle target. Without
+# a profile the crawl keeps the single slot and DOWNLOAD_DELAY above.
+CRAWL_PROFILE = None
+CRAWL_PROFILES = {
+    'polite': {
+        'slots': {
+            'shelf': {'concurrency': 1, 'delay': 3, 'target_concurrency': 1.0},
+            'book': {'concurrency': 1, 'delay': 3, 'target_concurrency': 1.0},
+            'progress': {'concurrency': 1, 'delay': 3,
+                         'target_concurrency': 1.0},
+        },
+    },
+    'balanced': {
+        'slots': {
+            'shelf': {'concurrency': 1, 'delay': 2, 'target_concurrency': 1.0},
+            'book': {'concurrency': 2, 'delay': 1, 'target_concurrency': 2.0},
+            'progress': {'concurrency': 2, 'delay': 0.5,
+                         'target_concurrency': 2.0},
+        },
+    },
+    'fast': {
+        'slots': {
+            'shelf': {'concurrency': 2, 'delay': 0.5,
+                      'target_concurrency': 2.0},
+            'book': {'concurrency': 4, 'delay': 0.25,
+                     'target_concurrency': 4.0},
+            'progress': {'concurrency': 8, 'delay': 0,
+                         'target_concurrency': 8.0},
+        },
+    },
+}
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'anobiicrawl.extensions.CrawlMetrics': 500,
+}
+
+# Write crawl metrics every METRICS_INTERVAL seconds and when the crawl
+# ends with `-s METRICS_PATH=metrics.json`
+METRICS_PATH = None
+METRICS_INTERVAL = 60
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'anobiicrawl.pipelines.AnobiicrawlPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'anobiicrawl.pipelines.SQLitePipeline': 300,
+    'anobiicrawl.pipelines.JsonLinesFeedPipeline': 310,
+}
+
+# Store crawled items in SQLite with `-s SQLITE_PATH=anobii_progress.db`
+SQLITE_PATH = None
+SQLITE_BATCH_SIZE = 100
+
+# Stream crawled items to `update_date.py --follow` with
+# `-s PROGRESS_FEED_PATH=anobii_progress.jl`
+PROGRESS_FEED_PATH = None
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -81,6 +141,13 @@ AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
 # Enable showing throttling stats for every response received:
 AUTOTHROTTLE_DEBUG = True
 
+# Resume an interrupted crawl by passing the same `-s JOBDIR=crawls/NAME`
+# again. Pending requests are kept in disk queues there, so memory stays
+# bounded on huge shelves, and LIFO queues make the crawl depth-first
+# among requests of the same priority.
+SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleLifoDiskQueue'
+SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.LifoMemoryQueue'
+
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 #HTTPCACHE_ENABLED = True
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
+import time
 
 from urllib.parse import urlparse, parse_qs
 
@@ -9,32 +11,92 @@ import diskcache as dc
 from scrapy.http import FormRequest
 
 from anobiicrawl.items import ProgressItem
+from anobiicrawl.middlewares import apply_crawl_profile
+
+
+def row_fingerprint(tr):
+    """Fingerprint a shelf row by its visible text and rating titles.
+
+    The row shows the reading status, its dates and the rating, so a new
+    fingerprint means the progress of the book has changed.
+    """
+    texts = tr.xpath('.//text() | .//@title | .//@alt').extract()
+    content = ' '.join(' '.join(texts).split())
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
 
 
 class ProgressSpider(scrapy.Spider):
     name = 'progress'
     allowed_domains = ['anobii.com']
 
-    bookshelf_url = 'http://www.anobii.com/book_shelf_public_ajax?personId={user}'
-    book_progress_url = 'http://www.anobii.com/anobiireload/c3/personal_book_reading/{item_id}/en'
-    login_page = 'http://www.anobii.com/login'
+    base_url = 'http://www.anobii.com'
+    bookshelf_url = '{base_url}/book_shelf_public_ajax?personId={user}'
+    book_progress_url = '{base_url}/anobiireload/c3/personal_book_reading/{item_id}/en'
+    login_page = '{base_url}/login'
+    # depth-first: finish books already found before turning shelf pages,
+    # and earlier shelf pages before later ones
     book_priority = 20
+    progress_priority = 30
+    # visited fingerprints written to disk per transaction
+    visited_flush_size = 100
 
-    def __init__(self, visited, user, login_path, *args, **kwargs):
+    def __init__(self, visited, user, login_path, base_url=None, failed=None,
+                 retry_failed=None, *args, **kwargs):
         super(ProgressSpider, self).__init__(*args, **kwargs)
         self.visited = dc.Cache(visited)
+        # look up shelf rows in memory; the cache is only read here and
+        # written in batches by flush_visited
+        self.visited_fingerprints = {isbn13: self.visited.get(isbn13)
+                                     for isbn13 in self.visited}
+        self.pending_visited = {}
+        # books whose progress could not be fetched, with the reason
+        self.failed = dc.Cache(failed or visited.rstrip('/\\') + '_failed')
+        self.failed_isbns = set(self.failed)
+        # only fetch the books in self.failed, without walking the shelf
+        self.retry_failed = str(retry_failed).lower() in ('1', 'true', 'yes')
         self.user = user
-        self.start_urls = [ProgressSpider.bookshelf_url.format(user=user)]
+        if base_url:
+            # e.g. a local mock server used for benchmarking
+            self.base_url = base_url.rstrip('/')
+            self.allowed_domains = [urlparse(self.base_url).hostname]
+        self.start_urls = [ProgressSpider.bookshelf_url.format(
+            base_url=self.base_url, user=user)]
 
         self.login_path = login_path
 
+    @property
+    def last_scheduled_page(self):
+        # the first shelf page is requested from start_urls
+        return getattr(self, 'state', {}).get('last_scheduled_page', 1)
+
+    @last_scheduled_page.setter
+    def last_scheduled_page(self, page):
+        # spider.state is persisted in JOBDIR, so a resumed crawl does not
+        # schedule the shelf pages again
+        if not hasattr(self, 'state'):
+            self.state = {}
+        self.state['last_scheduled_page'] = page
+
+    @classmethod
+    def update_settings(cls, settings):
+        super(ProgressSpider, cls).update_settings(settings)
+        apply_crawl_profile(settings)
+
     def start_requests(self):
-        yield scrapy.Request(url=ProgressSpider.login_page,
-                             callback=self.login)
+        yield scrapy.Request(
+            url=ProgressSpider.login_page.format(base_url=self.base_url),
+            callback=self.login,
+            # cookies are not persisted, so log in again when resuming
+            dont_filter=True)
 
     def check_login(self, response):
+        if self.retry_failed:
+            for request in self.failed_requests():
+                yield request
+            return
         for url in self.start_urls:
-            yield self.make_requests_from_url(url)
+            yield scrapy.Request(url, self.parse,
+                                 meta={'request_type': 'shelf'})
 
     def login(self, response):
         with open(self.login_path, encoding='utf8') as f:
@@ -42,32 +104,151 @@ class ProgressSpider(scrapy.Spider):
         yield FormRequest.from_response(response,
                                         formdata=login_data,
                                         formid='login-nav',
-                                        callback=self.check_login)
+                                        callback=self.check_login,
+                                        dont_filter=True)
 
     def parse_progress(self, response):
-        progress = json.loads(response.body_as_unicode())
         isbn13 = response.meta['isbn13']
         title = response.meta['title']
+        try:
+            progress = json.loads(response.text)
+        except ValueError as e:
+            self.record_failure(response.meta, 'bad progress JSON: {}'.format(
+                e))
+            return
 
-        self.logger.warning('process item: %s: %s', isbn13, title)
+        self.logger.debug('process item: %s: %s', isbn13, title)
         item = ProgressItem(title=title, isbn13=isbn13, progress=progress)
         yield item
-        self.visited[item['isbn13']] = ''
+        # legacy caches store '' and get re-fetched once to record it
+        self.visited_fingerprints[isbn13] = response.meta['fingerprint']
+        self.pending_visited[isbn13] = response.meta['fingerprint']
+        if len(self.pending_visited) >= self.visited_flush_size:
+            self.flush_visited()
+        if isbn13 in self.failed_isbns:
+            self.failed_isbns.discard(isbn13)
+            self.failed.delete(isbn13)
+
+    def flush_visited(self):
+        """Write the pending visited fingerprints in one transaction."""
+        if not self.pending_visited:
+            return
+        with self.visited.transact():
+            for isbn13, fingerprint in self.pending_visited.items():
+                self.visited[isbn13] = fingerprint
+        self.pending_visited = {}
+
+    def closed(self, reason):
+        self.flush_visited()
+        self.visited.close()
+        self.failed.close()
+
+    def record_failure(self, meta, reason):
+        """Remember a book whose progress could not be fetched."""
+        isbn13 = meta['isbn13']
+        previous = self.failed.get(isbn13) or {}
+        self.logger.warning('failed: %s: %s: %s', isbn13, meta['title'],
+                            reason)
+        self.failed_isbns.add(isbn13)
+        self.failed[isbn13] = {
+            'title': meta['title'],
+            'fingerprint': meta['fingerprint'],
+            'book_url': meta.get('book_url') or previous.get('book_url'),
+            'item_id': meta.get('item_id') or previous.get('item_id'),
+            'reason': reason,
+            'time': time.time(),
+            'attempts': previous.get('attempts', 0) + 1,
+        }
+
+    def fetch_failed(self, failure):
+        self.record_failure(failure.request.meta, repr(failure.value))
+
+    def failed_requests(self):
+        """Fetch the books recorded in self.failed again."""
+        for isbn13 in list(self.failed):
+            entry = self.failed.get(isbn13)
+            if entry is None:
+                continue
+            if entry['item_id']:
+                yield self.progress_request(entry['item_id'], isbn13,
+                                            entry['title'],
+                                            entry['fingerprint'],
+                                            book_url=entry['book_url'])
+            elif entry['book_url']:
+                yield self.book_request(entry['book_url'], isbn13,
+                                        entry['title'], entry['fingerprint'])
+
+    def progress_request(self, item_id, isbn13, title, fingerprint,
+                         book_url=None, fallback=True):
+        """Request reading progress of a book.
+
+        When ``book_url`` is given the item_id came from the shelf, and the
+        book page is only requested if the direct progress request fails,
+        unless ``fallback`` is False because it came from the book page.
+        """
+        url = ProgressSpider.book_progress_url.format(base_url=self.base_url,
+                                                      item_id=item_id)
+        if book_url and fallback:
+            errback = self.progress_failed
+        else:
+            errback = self.fetch_failed
+        return scrapy.Request(url,
+                              self.parse_progress,
+                              errback=errback,
+                              priority=ProgressSpider.progress_priority,
+                              # retried books are fetched again on purpose,
+                              # and after the book page the same URL may
+                              # already have failed from the shelf
+                              dont_filter=self.retry_failed or not fallback,
+                              meta={'isbn13': isbn13,
+                                    'title': title,
+                                    'fingerprint': fingerprint,
+                                    'book_url': book_url,
+                                    'item_id': item_id,
+                                    'request_type': 'progress'})
+
+    def book_request(self, book_url, isbn13, title, fingerprint):
+        return scrapy.Request(book_url,
+                              self.parse_book,
+                              errback=self.fetch_failed,
+                              priority=ProgressSpider.book_priority,
+                              dont_filter=self.retry_failed,
+                              meta={'isbn13': isbn13,
+                                    'title': title,
+                                    'fingerprint': fingerprint,
+                                    'book_url': book_url,
+                                    'request_type': 'book'})
+
+    def progress_failed(self, failure):
+        meta = failure.request.meta
+        self.logger.info('fall back to book page: %s: %s', meta['isbn13'],
+                         meta['title'])
+        # keep the book for retry_failed until parse_progress succeeds, even
+        # if the fallback is dropped before reaching an errback
+        self.record_failure(meta, repr(failure.value))
+        yield self.book_request(meta['book_url'], meta['isbn13'],
+                                meta['title'], meta['fingerprint'])
 
     def parse_book(self, response):
         item_id = response.xpath(
             '//input[@class="item_id"]/@value').extract_first()
         isbn13 = response.meta['isbn13']
         title = response.meta['title']
-        self.logger.warning('process edit: %s / %s / %s', item_id, isbn13,
-                            title)
+        self.logger.debug('process edit: %s / %s / %s', item_id, isbn13,
+                          title)
         if item_id:
-            url = ProgressSpider.book_progress_url.format(item_id=item_id)
-            yield scrapy.Request(url,
-                                 self.parse_progress,
-                                 priority=ProgressSpider.book_priority,
-                                 meta={'isbn13': isbn13,
-                                       'title': title})
+            yield self.progress_request(item_id, isbn13, title,
+                                        response.meta['fingerprint'],
+                                        book_url=response.meta.get('book_url'),
+                                        fallback=False)
+        else:
+            self.record_failure(response.meta, 'no item_id on book page')
+
+    def inc_stat(self, key):
+        # spiders built outside a crawl, e.g. by bench_parse, have no stats
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.stats.inc_value(key)
 
     def parse(self, response):
         for tr in response.xpath('//table//tr[@class="item"]'):
@@ -76,23 +257,43 @@ class ProgressSpider(scrapy.Spider):
             book_url_tokens = book_url.split('/')
             isbn13 = book_url_tokens[-3]
             title = book_url_tokens[-4]
-            self.logger.warning('%s: %s / %s', item_id_encrypted, isbn13,
-                                title)
+            self.logger.debug('%s: %s / %s', item_id_encrypted, isbn13, title)
 
-            if isbn13 not in self.visited and isbn13:
+            fingerprint = row_fingerprint(tr)
+            if (isbn13 and
+                    self.visited_fingerprints.get(isbn13) != fingerprint):
                 url = response.urljoin(book_url)
-                yield scrapy.Request(url,
-                                     self.parse_book,
-                                     priority=ProgressSpider.book_priority,
-                                     meta={'isbn13': isbn13,
-                                           'title': title})
-
-        next_page_url = response.xpath(
-            '//p[contains(@class, "pagination_wrap")]//a[contains(@class, "next")]/@href')
-        if next_page_url:
-            next_url = response.urljoin(next_page_url.extract_first())
-            next_page = parse_qs(urlparse(next_url).query)['page'][0]
+                # the shelf row may already carry the item_id, which saves
+                # the book page request. These selectors match the mock
+                # server only: it is unknown whether real aNobii rows carry
+                # the item_id, and how the encrypted row id relates to it.
+                # The shelf/* stats show which path a crawl took.
+                item_id = tr.xpath(
+                    './/input[@class="item_id"]/@value | @data-item-id'
+                ).extract_first()
+                if item_id:
+                    self.inc_stat('shelf/direct_progress')
+                    yield self.progress_request(item_id, isbn13, title,
+                                                fingerprint, book_url=url)
+                else:
+                    self.inc_stat('shelf/book_page')
+                    yield self.book_request(url, isbn13, title, fingerprint)
+
+        # schedule every page the pagination knows about at once instead of
+        # walking the "next" links one by one
+        last_page = self.last_scheduled_page
+        for href in response.xpath(
+                '//p[contains(@class, "pagination_wrap")]//a/@href').extract():
+            page = parse_qs(urlparse(response.urljoin(href)).query).get('page')
+            if page and page[0].isdigit():
+                last_page = max(last_page, int(page[0]))
+
+        for page in range(self.last_scheduled_page + 1, last_page + 1):
             url = ProgressSpider.bookshelf_url.format(
-                user=self.user) + '&page={}'.format(next_page)
-            self.logger.warning('turn to next page: %s', url)
-            yield scrapy.Request(url, self.parse)
+                base_url=self.base_url,
+                user=self.user) + '&page={}'.format(page)
+            self.logger.debug('schedule page: %s', url)
+            yield scrapy.Request(url, self.parse,
+                                 priority=-page,
+                                 meta={'request_type': 'shelf'})
+        self.last_scheduled_page = last_page
@@ -0,0 +1,22 @@
+from setuptools import setup
+
+setup(
+    name='anobii2goodreads',
+    version='0.1.0',
+    description='Convert aNobii exports and reading progress to Goodreads.',
+    url='https://github.com/shaform/anobii2goodreads',
+    license='GPLv3',
+    packages=['anobii2goodreads'],
+    python_requires='>=3.5',
+    install_requires=[
+        'pyisbn',
+        'requests',
+        'beautifulsoup4',
+        'diskcache',
+    ],
+    entry_points={
+        'console_scripts': [
+            'anobii2goodreads=anobii2goodreads.cli:main',
+        ],
+    },
+)